@@ -1,10 +1,160 @@
 import argparse
 import os
 import random
-import music21 as m21
+import pretty_midi
 import numpy as np
-
-def main(file, instr, spice, tempo, output):
+import tune_cache
+import metrics
+
+# ornamentation tables, as midi note numbers
+
+# cuts for different instruments
+CUTS = {
+    'accordion': {
+        62: 64,  # D4 -> E4
+        74: 76,  # D5 -> E5
+        64: 66,  # E4 -> F#4
+        76: 78,  # E5 -> F#5
+        78: 81,  # F#5 -> A5
+        67: 69,  # G4 -> A4
+        79: 83,  # G5 -> B5
+        69: 71,  # A4 -> B4
+        81: 83,  # A5 -> B5
+        59: 62,  # B3 -> D4
+        71: 74,  # B4 -> D5
+        60: 64,  # C4 -> E4
+        72: 76   # C5 -> E5
+    },
+    'fiddle': {
+        62: 64,  # D4 -> E4
+        74: 76,  # D5 -> E5
+        64: 66,  # E4 -> F#4
+        76: 78,  # E5 -> F#5
+        65: 67,  # F4 -> G4
+        66: 67,  # F#4 -> G4
+        78: 81,  # F#5 -> A5
+        67: 69,  # G4 -> A4
+        79: 83,  # G5 -> B5
+        69: 71,  # A4 -> B4
+        81: 83,  # A5 -> B5
+        59: 60,  # B3 -> C4
+        71: 74,  # B4 -> D5
+        60: 62,  # C4 -> D4
+        72: 74   # C5 -> D5
+    },
+    'flute': {
+        64: 66,  # E4 -> F#4
+        76: 78,  # E5 -> F#5
+        66: 69,  # F#4 -> A4
+        78: 81,  # F#5 -> A5
+        67: 69,  # G4 -> A4
+        79: 81,  # G5 -> A5
+        69: 71,  # A4 -> B4
+        72: 74   # C5 -> D5
+    },
+    'whistle': {
+        76: 78,  # E5 -> F#5
+        88: 90,  # E6 -> F#6
+        78: 81,  # F#5 -> A5
+        90: 93,  # F#6 -> A6
+        79: 81,  # G5 -> A5
+        91: 93,  # G6 -> A6
+        81: 83,  # A5 -> B5
+        84: 86   # C6 -> D6
+    }
+}
+
+VELOCITIES = {
+    'accordion': 80,
+    'fiddle': 60,
+    'flute': 80,
+    'whistle': 80
+}
+
+# lowest and highest note
+RANGES = {
+    'accordion': (53, 91),  # F3, G6
+    'fiddle': (55, 105),    # G3, A7
+    'flute': (60, 96),      # C4, C7
+    'whistle': (72, 95)     # C5, B6
+}
+
+# velocity of the notes without one (music21's default volume)
+DEFAULT_VELOCITY = 90
+
+# midi resolution, as music21 writes it
+TICKS_PER_QUARTER = 10080
+
+
+class Note:
+    """
+    A note as midi pitch, offset in its bar and duration in quarter lengths, velocity,
+    and tie ('start', 'continue', 'stop' or None) for the parts of a note split at bar lines.
+    """
+
+    __slots__ = ('pitch', 'offset', 'duration', 'velocity', 'tie')
+
+    def __init__(self, pitch, offset, duration, velocity=DEFAULT_VELOCITY, tie=None):
+        self.pitch = pitch
+        self.offset = offset
+        self.duration = duration
+        self.velocity = velocity
+        self.tie = tie
+
+
+def read_tune(file):
+    """
+    Bars of a tune (a path or midi data) as (duration, notes), its bar duration and the pitch class of its key.
+    The notes are fresh copies, music21 is only used for the tunes the fast reader cannot handle.
+    """
+    # key and time signature are analyzed once per tune, for all its parts
+    meta = tune_cache.metadata(file)
+
+    bars = [(duration, [Note(pitch, offset, note_duration, tie=tie) for pitch, offset, note_duration, tie in notes])
+            for _, duration, notes in tune_cache.read(file)['bars']]
+
+    return bars, meta['bar_duration'], meta['tonic']
+
+
+def to_midi(notes, tempo):
+    """
+    A pretty_midi tune playing the notes one after the other, each one starting where the previous one ends.
+    Tied notes are played as one, as music21 writes them: from the first part, for the total of their
+    durations and with the velocity of the first part (the cuts in between are still played).
+    """
+    midi = pretty_midi.PrettyMIDI(resolution=TICKS_PER_QUARTER, initial_tempo=tempo)
+    instrument = pretty_midi.Instrument(program=0)
+
+    quarter = 60/tempo
+    t = 0.0
+    tied = None
+    for note in notes:
+        end = t + float(note.duration)
+        if note.tie in ('continue', 'stop') and tied is not None:
+            tied.end += float(note.duration)*quarter
+        else:
+            instrument.notes.append(pretty_midi.Note(velocity=note.velocity, pitch=note.pitch,
+                                                     start=t*quarter, end=end*quarter))
+            if note.tie == 'start':
+                tied = instrument.notes[-1]
+        if note.tie == 'stop':
+            tied = None
+        t = end
+
+    midi.instruments.append(instrument)
+    return midi
+
+
+def write_midi(notes, tempo, path):
+    to_midi(notes, tempo).write(path)
+
+
+def part_name(file, instr, spice, tempo):
+    return f'{os.path.basename(file)}_{instr}_{float(spice)}_{tempo}_.mid'
+
+
+def ornament(tune, instr, spice):
+    """The notes of a tune read with read_tune, ornamented for an instrument."""
     spice = float(spice)
     grace_val = 1/8
 
@@ -13,137 +163,49 @@ def main(file, instr, spice, tempo, output):
     CUTS_FREQ = np.clip(spice + random.uniform(-0.1, 0.1), 0, 1)
     CUTS_FREQ_MID = CUTS_FREQ/2
     GRACE_FREQ = np.clip(CUTS_FREQ + random.uniform(-0.1, 0.1), 0, 1)
-    GRACE_DURATION = m21.duration.Duration(grace_val)
     MAX_BAR_ORNAMENTS = spice*4
 
     # retrieve music
-    tune = m21.converter.parse(file)
-    bars = tune.parts[0].getElementsByClass(m21.stream.Measure)
-
-    time_signature = tune.recurse().getElementsByClass(m21.meter.TimeSignature)[0]
-    bar_duration = time_signature.beatCount * time_signature.beatDuration.quarterLength
+    bars, bar_duration, tonic = tune
     mid_bar = bar_duration / 2
 
-    key = tune.recurse().getElementsByClass(m21.key.KeySignature)
-    if len(key) == 0:
-        key = tune.analyze('key')[0]
-    else:
-        key = key[0]
-
-    # create new score
-    new_stream = m21.stream.Score(id='ornaments')
-    prev = m21.note.Unpitched()
-
-    # cuts for different instruments
-
-    instruments = {
-        'accordion': {
-            m21.pitch.Pitch('D4'): m21.pitch.Pitch('E4'),
-            m21.pitch.Pitch('D5'): m21.pitch.Pitch('E5'),
-            m21.pitch.Pitch('E4'): m21.pitch.Pitch('F#4'),
-            m21.pitch.Pitch('E5'): m21.pitch.Pitch('F#5'),
-            m21.pitch.Pitch('F#5'): m21.pitch.Pitch('A5'),
-            m21.pitch.Pitch('G4'): m21.pitch.Pitch('A4'),
-            m21.pitch.Pitch('G5'): m21.pitch.Pitch('B5'),
-            m21.pitch.Pitch('A4'): m21.pitch.Pitch('B4'),
-            m21.pitch.Pitch('A5'): m21.pitch.Pitch('B5'),
-            m21.pitch.Pitch('B3'): m21.pitch.Pitch('D4'),
-            m21.pitch.Pitch('B4'): m21.pitch.Pitch('D5'),
-            m21.pitch.Pitch('C4'): m21.pitch.Pitch('E4'),
-            m21.pitch.Pitch('C5'): m21.pitch.Pitch('E5')
-        },
-        'fiddle': {
-            m21.pitch.Pitch('D4'): m21.pitch.Pitch('E4'),
-            m21.pitch.Pitch('D5'): m21.pitch.Pitch('E5'),
-            m21.pitch.Pitch('E4'): m21.pitch.Pitch('F#4'),
-            m21.pitch.Pitch('E5'): m21.pitch.Pitch('F#5'),
-            m21.pitch.Pitch('F4'): m21.pitch.Pitch('G4'),
-            m21.pitch.Pitch('F#4'): m21.pitch.Pitch('G4'),
-            m21.pitch.Pitch('F#5'): m21.pitch.Pitch('A5'),
-            m21.pitch.Pitch('G4'): m21.pitch.Pitch('A4'),
-            m21.pitch.Pitch('G5'): m21.pitch.Pitch('B5'),
-            m21.pitch.Pitch('A4'): m21.pitch.Pitch('B4'),
-            m21.pitch.Pitch('A5'): m21.pitch.Pitch('B5'),
-            m21.pitch.Pitch('B3'): m21.pitch.Pitch('C4'),
-            m21.pitch.Pitch('B4'): m21.pitch.Pitch('D5'),
-            m21.pitch.Pitch('C4'): m21.pitch.Pitch('D4'),
-            m21.pitch.Pitch('C5'): m21.pitch.Pitch('D5')
-        },
-        'flute': {
-            m21.pitch.Pitch('E4'): m21.pitch.Pitch('F#4'),
-            m21.pitch.Pitch('E5'): m21.pitch.Pitch('F#5'),
-            m21.pitch.Pitch('F#4'): m21.pitch.Pitch('A4'),
-            m21.pitch.Pitch('F#5'): m21.pitch.Pitch('A5'),
-            m21.pitch.Pitch('G4'): m21.pitch.Pitch('A4'),
-            m21.pitch.Pitch('G5'): m21.pitch.Pitch('A5'),
-            m21.pitch.Pitch('A4'): m21.pitch.Pitch('B4'),
-            m21.pitch.Pitch('C5'): m21.pitch.Pitch('D5')
-        },
-        'whistle': {
-            m21.pitch.Pitch('E5'): m21.pitch.Pitch('F#5'),
-            m21.pitch.Pitch('E6'): m21.pitch.Pitch('F#6'),
-            m21.pitch.Pitch('F#5'): m21.pitch.Pitch('A5'),
-            m21.pitch.Pitch('F#6'): m21.pitch.Pitch('A6'),
-            m21.pitch.Pitch('G5'): m21.pitch.Pitch('A5'),
-            m21.pitch.Pitch('G6'): m21.pitch.Pitch('A6'),
-            m21.pitch.Pitch('A5'): m21.pitch.Pitch('B5'),
-            m21.pitch.Pitch('C6'): m21.pitch.Pitch('D6')
-        }
-    }
-
-    velocities = {
-        'accordion': 80,
-        'fiddle': 60,
-        'flute': 80,
-        'whistle': 80
-    }
-
-    ranges = {
-        'accordion': [m21.pitch.Pitch('F3'), m21.pitch.Pitch('G6')],
-        'fiddle': [m21.pitch.Pitch('G3'), m21.pitch.Pitch('A7')],
-        'flute': [m21.pitch.Pitch('C4'), m21.pitch.Pitch('C7')],
-        'whistle': [m21.pitch.Pitch('C5'), m21.pitch.Pitch('B6')]
-    }
+    # the ornamented notes, in order
+    notes = []
+    prev = None
 
+    low, high = RANGES[instr]
     accordion_transpose = instr == 'accordion' and random.uniform(0, 1) < 0.75
 
     def constrain_range(note):
         if accordion_transpose:
-            note.octave -= 1
+            note.pitch -= 12
         elif instr == 'whistle':
-            note.octave += 1
+            note.pitch += 12
 
-        while note.pitch < ranges[instr][0]:
-            note.octave += 1
+        while note.pitch < low:
+            note.pitch += 12
 
-        while note.pitch > ranges[instr][1]:
-            note.octave -= 1
+        while note.pitch > high:
+            note.pitch -= 12
 
         return note
 
     # assigned model
-    cuts = instruments[instr]
+    cuts = CUTS[instr]
     offset = 0
 
-    note_vel = velocities[instr]
+    note_vel = VELOCITIES[instr]
 
     # go through each bar
     for i in range(len(bars)-1):
 
-        bar = bars[i]
-
-        # create measure
-        m = m21.stream.Measure(number=i)
-
-        # append tempo indication if first one
-        if i == 0:
-            m.append(m21.tempo.MetronomeMark(number=int(tempo)))
+        bar_length, bar_notes = bars[i]
 
         # keep track of the ornamentation
         bar_ornaments = 0
 
         # count bars
-        if bar.duration.quarterLength < mid_bar:
+        if bar_length < mid_bar:
             offset += 1
 
         # check if first or last bar of a phrase
@@ -151,16 +213,15 @@ def main(file, instr, spice, tempo, output):
         last = (i - offset) % PHRASE_LEN == PHRASE_LEN-1
 
         # go through each elem in the bar
-        for current in bar.notes:
+        for current in bar_notes:
 
             # make all notes fit in range
             current = constrain_range(current)
-            pitch_key = m21.pitch.Pitch(current.pitch)
 
             # if not first or last bar
             # and there is a cut for that note
             # and we are below the ornamentation limit
-            if ((not first and not last) and pitch_key in cuts and bar_ornaments < MAX_BAR_ORNAMENTS):
+            if ((not first and not last) and current.pitch in cuts and bar_ornaments < MAX_BAR_ORNAMENTS):
 
                 # try to generate a cut
                 # if we are at the start of the bar
@@ -168,70 +229,62 @@ def main(file, instr, spice, tempo, output):
                 # if there are two equal notes
                 if ((current.offset == 0 and random.uniform(0,1) < CUTS_FREQ)
                         or (current.offset == mid_bar and random.uniform(0,1) < CUTS_FREQ_MID)
-                        or (prev.pitch == current.pitch and random.uniform(0,1) < GRACE_FREQ)):
+                        or (prev is not None and prev.pitch == current.pitch and random.uniform(0,1) < GRACE_FREQ)):
 
-                    grace = m21.note.Note(cuts[pitch_key], duration=GRACE_DURATION)
-                    grace.volume = note_vel
-                    m.append(grace)
-                    current.duration.quarterLength -= grace_val
-                    bar_ornaments += 1
+                    # no cut on a note (or the part of a tied note) not longer than the cut itself
+                    if current.duration > grace_val:
+                        notes.append(Note(cuts[current.pitch], current.offset, grace_val, note_vel))
+                        current.duration -= grace_val
+                        bar_ornaments += 1
 
-            # append current to new measure
+            # append current
             velocity_val = note_vel + random.randint(-2, 2)
             if current.offset == 0:
                 velocity_val += 5
             elif current.offset == mid_bar:
                 velocity_val += 3
 
-            current.volume = velocity_val
-            m.append(current)
+            current.velocity = velocity_val
+            notes.append(current)
             prev = current
 
-        # append measure to score
-        new_stream.append(m)
-
 
     # last measure
-    last_bar_notes = list(bars[-1].notes)
+    last_bar_notes = bars[-1][1]
     last_dur = 0
     i = len(last_bar_notes)-1
-    while last_bar_notes[i].pitch.pitchClass != key.tonic.pitchClass and i > 0:
-        last_dur += last_bar_notes[i].duration.quarterLength
+    while last_bar_notes[i].pitch % 12 != tonic and i > 0:
+        last_dur += last_bar_notes[i].duration
         i -= 1
 
     if last_dur == 0:
-        last_dur = last_bar_notes[i].duration.quarterLength
-
-    m = m21.stream.Measure(number=len(bars)-1)
+        last_dur = last_bar_notes[i].duration
 
     if i != 0:
         # append notes until the tonic
         for note in last_bar_notes[:i]:
             note = constrain_range(note)
-            note.volume = note_vel + random.randint(-2, 2)
-            m.append(note)
+            note.velocity = note_vel + random.randint(-2, 2)
+            notes.append(note)
 
-        final = m21.note.Note(last_bar_notes[i].pitch, duration=m21.duration.Duration(quarterLength=last_dur))
-        m.append(final)
+        notes.append(Note(last_bar_notes[i].pitch, 0, last_dur))
     else:
-        # append only final tonic                                             
-        end_note = constrain_range(
-            m21.note.Note(f'{key.tonic}{list(bars[-1].notes)[-1].octave}',
-                          duration=m21.duration.Duration(quarterLength=6)))
-        end_note.volume = note_vel
-        m.append(end_note)
+        # append only final tonic, in the octave of the last note
+        end_note = constrain_range(Note(12*(last_bar_notes[-1].pitch // 12) + tonic, 0, 6, note_vel))
+        notes.append(end_note)
 
-    new_stream.append(m)
+    return notes
 
 
+@metrics.measured('abc_spicer', tune_arg=0)
+def main(file, instr, spice, tempo, output):
+    notes = ornament(read_tune(file), instr, spice)
 
     # save the file
-    filename = ''
-    with open(file) as f:
-        filename = os.path.basename(f.name)
+    out_file = f'{output}/{part_name(file, instr, spice, tempo)}'
+    write_midi(notes, int(tempo), out_file)
 
-    #new_stream.show()
-    new_stream.write('midi', f'{output}/{filename}_{instr}_{spice}_{tempo}_.mid')
+    return out_file
 
 if __name__ == 'main':
    # args
@@ -0,0 +1,92 @@
+import os
+import hashlib
+import numpy as np
+import soundfile as sf
+
+# Stomps, ambiences and impulse responses, checked and converted once.
+# Converted audio is stored as float32 .npy files and memory-mapped,
+# so reading a slice of a long ambience only touches that slice.
+
+SAMPLE_RATE = 16000
+ASSET_CACHE_DIR = os.environ.get('FOLKRNN_ASSET_CACHE', './.asset_cache')
+
+# arrays already mapped by this process
+_loaded = {}
+
+
+def cache_path(file, ext):
+    # the cache entry changes with the file
+    st = os.stat(file)
+    key = f'{os.path.abspath(file)}:{st.st_size}:{st.st_mtime_ns}'
+    return f'{ASSET_CACHE_DIR}/{hashlib.sha1(key.encode()).hexdigest()}{ext}'
+
+
+def resample(file, audio, sr):
+    # audio is (frames, channels)
+    print(f'{file}: resampling from {sr} to {SAMPLE_RATE} Hz')
+    import librosa
+    return librosa.resample(audio.T, orig_sr=sr, target_sr=SAMPLE_RATE).T.astype(np.float32)
+
+
+def convert(file):
+    """Read an audio file as float32 mono at SAMPLE_RATE."""
+    audio, sr = sf.read(file, dtype='float32', always_2d=True)
+
+    if audio.shape[1] != 1:
+        print(f'{file}: {audio.shape[1]} channels, mixing down to mono')
+        audio = audio.mean(axis=1, keepdims=True)
+
+    if sr != SAMPLE_RATE:
+        audio = resample(file, audio, sr)
+
+    return audio[:, 0]
+
+
+def write_atomic(path, write):
+    # several processes may convert the same asset
+    os.makedirs(ASSET_CACHE_DIR, exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    write(tmp)
+    os.replace(tmp, path)
+
+
+def save(path, audio):
+    # np.save would append .npy to the temporary name given as a path
+    with open(path, 'wb') as f:
+        np.save(f, audio)
+
+
+def load(file):
+    """Memory-mapped float32 mono samples of an audio file, converted on first use."""
+    path = cache_path(file, '.npy')
+
+    if path not in _loaded:
+        if not os.path.exists(path):
+            audio = convert(file)
+            write_atomic(path, lambda tmp: save(tmp, audio))
+        _loaded[path] = np.load(path, mmap_mode='r')
+
+    return _loaded[path]
+
+
+def load_dir(folder):
+    """All the assets of a folder, in name order."""
+    return [load(f'{folder}/{f}') for f in sorted(os.listdir(folder))]
+
+
+def impulse(file):
+    """
+    Path of an impulse response at SAMPLE_RATE, for Convolution. The channels are kept,
+    a stereo response gives the reverb its stereo image.
+    """
+    sr = sf.info(file).samplerate
+    if sr == SAMPLE_RATE:
+        return file
+
+    # resampled once, rather than by every Convolution built from it
+    path = cache_path(file, '.wav')
+    if not os.path.exists(path):
+        audio = resample(file, sf.read(file, dtype='float32', always_2d=True)[0], sr)
+        write_atomic(path, lambda tmp: sf.write(tmp, audio, SAMPLE_RATE, subtype='FLOAT', format='WAV'))
+
+    return path
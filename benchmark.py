@@ -0,0 +1,295 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+from fractions import Fraction
+import numpy as np
+import soundfile as sf
+import pretty_midi
+
+import repeat_midi
+import abc_spicer
+import stomping
+import microtiming
+import mixer
+import tune_cache
+
+RENDER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'render')
+sys.path.append(RENDER_DIR)
+import load_midi
+
+SAMPLE_RATE = 16000
+FEATURE_FRAME_RATE = 250
+TEMPO = 120
+
+# D major scale for the synthetic tunes
+SCALE = [62, 64, 66, 67, 69, 71, 73, 74, 76, 78, 79, 81]
+
+
+###### fixtures ######
+
+def make_tune(path, bars, rng, meter=(6, 8), key=2, rhythm=None, pickup=0):
+    """
+    Monophonic tune of `bars` bars ending on the tonic, by default jig-like: quavers in 6/8.
+    `rhythm` is a list of note groups (lengths in quarters, e.g. a triplet or a note tied over
+    the bar line) to draw from instead, `pickup` a rest before the first note (quarters),
+    and without `key` the tune has no key signature.
+    """
+    midi = pretty_midi.PrettyMIDI(initial_tempo=TEMPO)
+    midi.time_signature_changes.append(pretty_midi.TimeSignature(*meter, 0))
+    if key is not None:
+        midi.key_signature_changes.append(pretty_midi.KeySignature(key, 0))
+
+    instr = pretty_midi.Instrument(program=0)
+    quarter = 60/TEMPO
+    end = bars*Fraction(4*meter[0], meter[1])
+    # exact positions, so triplets add up
+    t = Fraction(pickup)
+    while t < end:
+        for length in ((Fraction(1, 2),) if rhythm is None else rng.choice(rhythm)):
+            instr.notes.append(pretty_midi.Note(velocity=80, pitch=rng.choice(SCALE),
+                                                start=float(t*quarter), end=float((t + length)*quarter)))
+            t += length
+    instr.notes[-1].pitch = SCALE[0]
+
+    midi.instruments.append(instr)
+    midi.write(path)
+
+
+def make_wav(path, seconds, rng, channels=1):
+    audio = np.random.default_rng(rng.randrange(2**32)).normal(0, 0.1, (int(seconds*SAMPLE_RATE), channels))
+    sf.write(path, audio if channels > 1 else audio[:, 0], SAMPLE_RATE)
+
+
+def make_assets(workspace, rng):
+    """Stub stomps, ambiences and impulse responses, laid out as the stages expect them."""
+    for d in ['stomps', 'ambiences', 'impulses']:
+        os.makedirs(f'{workspace}/{d}')
+
+    for i in range(4):
+        make_wav(f'{workspace}/stomps/stomp{i}.wav', 0.2, rng)
+    make_wav(f'{workspace}/ambiences/ambience0.wav', 600, rng)
+
+    # short exponentially decaying noise as impulse response
+    ir = np.random.default_rng(0).normal(0, 1, SAMPLE_RATE//2)*np.exp(-np.linspace(0, 8, SAMPLE_RATE//2))
+    sf.write(f'{workspace}/impulses/room.wav', ir, SAMPLE_RATE)
+
+
+def make_models(clip_duration, channels=32):
+    """Tiny randomly-initialized control and synthesis models for a clip length."""
+    import gin
+    import ddsp.training
+    import tensorflow.compat.v2 as tf
+    from control_models import AimuControlModel
+    from synthesis_models import get_clip_gin
+
+    n_frames = clip_duration*FEATURE_FRAME_RATE
+    dummy = {'midi_pitch': np.full((1, n_frames, 1), 62, dtype=np.float32),
+             'midi_velocity': np.full((1, n_frames, 1), 80, dtype=np.float32)}
+
+    control_model = AimuControlModel(n_timesteps=n_frames, rnn_channels=channels)
+    control_model(dummy, training=False)
+
+    gin.parse_config_file(get_clip_gin(clip_duration))
+    gin.bind_parameter('RnnFcDecoder.ch', channels)
+    gin.bind_parameter('RnnFcDecoder.rnn_channels', channels)
+    synthesis_model = ddsp.training.models.Autoencoder()
+    synthesis_model.decode({k: tf.ones((1, n_frames, 1)) for k in ['ld_scaled', 'f0_scaled', 'f0_hz']})
+
+    return control_model, synthesis_model
+
+
+###### timing ######
+
+def cold_cache():
+    """Forget the tunes read so far, in memory and on disk, as for the first part of a tune."""
+    tune_cache.clear()
+    shutil.rmtree(tune_cache.TUNE_CACHE_DIR, ignore_errors=True)
+
+
+def timed(fn, repeat):
+    """Median wall time of `repeat` calls of fn, with the stage output silenced."""
+    times = []
+    for _ in range(repeat):
+        st = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            fn()
+        times.append(time.perf_counter() - st)
+    return float(np.median(times))
+
+
+def bench_symbolic(workspace, bars, rng, repeat, results):
+    src = f'{workspace}/src/tune{bars}.mid'
+    tmp = f'{workspace}/tmp/tune{bars}.mid'
+    midi_dir = f'{workspace}/midi/fiddle'
+    stomp_dir = f'{workspace}/audio/stomps'
+    make_tune(src, bars, rng)
+
+    def spice():
+        cold_cache()
+        random.seed(0)
+        return abc_spicer.main(tmp, 'fiddle', 0.5, TEMPO, midi_dir)
+
+    def stomp():
+        cold_cache()
+        random.seed(0)
+        stomping.main(tmp, TEMPO, stomp_dir)
+
+    results[f'repeat_midi/bars={bars}'] = timed(lambda: repeat_midi.main(src, 3, tmp), repeat)
+    results[f'abc_spicer/bars={bars}'] = timed(spice, repeat)
+    results[f'stomping/bars={bars}'] = timed(stomp, repeat)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        part = spice()
+    micro_part = part.replace('.mid', '_micro.mid')
+    results[f'microtiming/bars={bars}'] = timed(lambda: microtiming.main(part, 0.25, micro_part), repeat)
+    results[f'load_midi/bars={bars}'] = timed(
+        lambda: load_midi.load_midi(micro_part, FEATURE_FRAME_RATE, None, 1, SAMPLE_RATE), repeat)
+
+    return micro_part
+
+
+def bench_render(parts, batch_sizes, repeat, results):
+    import trn_lib
+
+    models = {}
+    for bars, part in parts.items():
+        batch = load_midi.load_midi(part, FEATURE_FRAME_RATE, None, 1, SAMPLE_RATE)
+        clip_duration = load_midi.clip_duration_of(batch, FEATURE_FRAME_RATE)
+        if clip_duration not in models:
+            models[clip_duration] = make_models(clip_duration)
+        control_model, synthesis_model = models[clip_duration]
+
+        for b in batch_sizes:
+            stacked = {k: np.concatenate([v]*b, axis=0) for k, v in batch.items()}
+            results[f'generate_performance/bars={bars}/batch={b}'] = timed(
+                lambda: trn_lib.generate_performance(control_model, synthesis_model, part, False, None,
+                                                     stacked, 0.25, 1, False), repeat)
+
+
+def bench_mixer(workspace, bars, rng, repeat, results):
+    audio_dir = f'{workspace}/mix{bars}/audio'
+    seconds = bars*3*60/TEMPO*3
+
+    # three instrument stems and the stomps of one tune, of different lengths as rendered:
+    # the parts padded to their clip length, the stomps ending before them, off the block grid
+    for i, instr in enumerate(['fiddle', 'whistle', 'accordion']):
+        os.makedirs(f'{audio_dir}/{instr}')
+        make_wav(f'{audio_dir}/{instr}/tune{bars}.mid_{instr}_0.5_{TEMPO}_.mid_generated_performance.wav',
+                 seconds + 2*(2 - i), rng)
+    os.makedirs(f'{audio_dir}/stomps')
+    make_wav(f'{audio_dir}/stomps/tune{bars}.mid_stomps_0_{TEMPO}.wav', seconds*0.8 + 0.37, rng)
+
+    def mix():
+        mixer.main(audio_dir, False, True, f'{workspace}/mix{bars}/songs', seed=0)
+
+    results[f'mixer/bars={bars}'] = timed(mix, repeat)
+
+
+###### report ######
+
+def compare(results, baseline, tolerance):
+    """Stages slower than the baseline by more than `tolerance` (relative)."""
+    regressions = {}
+    for stage, t in results.items():
+        if stage in baseline and t > baseline[stage]*(1 + tolerance):
+            regressions[stage] = {'baseline': baseline[stage], 'current': t, 'ratio': t/baseline[stage]}
+    return regressions
+
+
+def main(bars_list, batch_sizes, repeat, output, baseline_file, tolerance, render, keep):
+    rng = random.Random(1234)
+    workspace = tempfile.mkdtemp(prefix='folkrnn_bench_')
+    cwd = os.getcwd()
+    output = os.path.abspath(output)
+    if baseline_file is not None:
+        baseline_file = os.path.abspath(baseline_file)
+
+    results = {}
+    skipped = []
+    # the tune metadata is cached in the workspace, the cold runs empty it
+    tune_cache_dir = tune_cache.TUNE_CACHE_DIR
+    tune_cache.TUNE_CACHE_DIR = f'{workspace}/.tune_cache'
+    try:
+        # the stages look for their assets in the working directory
+        os.chdir(workspace)
+        for d in ['src', 'tmp', 'midi/fiddle', 'audio/stomps']:
+            os.makedirs(d)
+        make_assets(workspace, rng)
+
+        parts = {}
+        for bars in bars_list:
+            print(f'Symbolic stages, {bars} bars')
+            parts[bars] = bench_symbolic(workspace, bars, rng, repeat, results)
+
+        if render:
+            try:
+                import ddsp
+            except ImportError:
+                skipped.append('generate_performance')
+                print('ddsp not available, skipping generate_performance')
+            else:
+                print('Rendering')
+                bench_render(parts, batch_sizes, repeat, results)
+
+        for bars in bars_list:
+            print(f'Mixer, {bars} bars')
+            bench_mixer(workspace, bars, rng, repeat, results)
+    finally:
+        os.chdir(cwd)
+        tune_cache.TUNE_CACHE_DIR = tune_cache_dir
+        if not keep:
+            shutil.rmtree(workspace)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'repeat': repeat,
+        },
+        'results': results,
+        'skipped': skipped,
+    }
+
+    for stage, t in results.items():
+        print(f'{stage:50s} {t:10.4f} s')
+
+    status = 0
+    if baseline_file is not None:
+        with open(baseline_file) as f:
+            baseline = json.load(f)['results']
+        report['regressions'] = compare(results, baseline, tolerance)
+        for stage, r in report['regressions'].items():
+            print(f'REGRESSION {stage}: {r["baseline"]:.4f} s -> {r["current"]:.4f} s ({r["ratio"]:.2f}x)')
+        status = 1 if report['regressions'] else 0
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Report written to {output}')
+
+    return status
+
+
+if __name__ == '__main__':
+    # args
+    parser = argparse.ArgumentParser(description='Time each pipeline stage on synthetic tunes')
+    parser.add_argument('--bars', type=int, nargs='+', default=[16, 32, 64], help='tune lengths in bars')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4], help='render batch sizes')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement (the median is kept)')
+    parser.add_argument('--output', default='benchmark.json', help='report file')
+    parser.add_argument('--baseline', default=None, help='report to compare against, exits with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown')
+    parser.add_argument('--no-render', action='store_true', help='skip the tensorflow stages')
+    parser.add_argument('--keep', action='store_true', help='keep the fixture folder')
+    args = parser.parse_args()
+    sys.exit(main(args.bars, args.batch_sizes, args.repeat, args.output, args.baseline,
+                  args.tolerance, not args.no_render, args.keep))
@@ -1,85 +1,414 @@
+import io
 import os
+import sys
 import time
+import json
+import shutil
 import argparse
 import random
+import queue
+import itertools
+import multiprocessing
+import multiprocessing.forkserver
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+import numpy as np
+import pretty_midi
 
 import repeat_midi
 import abc_spicer
 import stomping
 import microtiming
 import mixer
+import deps
+import metrics
+import tune_cache
 
-# args
-parser = argparse.ArgumentParser(description='Generate and render individual instrument parts for folk tunes')
-parser.add_argument('input', help='Folder with the files to process')
-parser.add_argument('output', help='Output folder for midi and audio')
-args = parser.parse_args()
+RENDER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'render')
+sys.path.append(RENDER_DIR)
+import render_queue
+import load_midi
 
-# dirs
-input_dir = args.input
-files = os.listdir(input_dir)
-output_dir = os.path.abspath(args.output)
+# instruments
+instr_list = ['fiddle', 'whistle', 'accordion']
 
-midi_output_dir = f'{output_dir}/midi'
-audio_output_dir = f'{output_dir}/audio'
-song_output_dir = f'{output_dir}/songs'
-stomp_output_dir = f'{audio_output_dir}/stomps'
-tmp_dir = f'{output_dir}/tmp'
 
-os.makedirs(tmp_dir)
+def arrange(seed):
+    """Random arrangement of a tune: instruments, spice and microtiming amounts, and the seeds of the stages."""
 
-# instruments
-instr_list = ['fiddle', 'whistle', 'accordion']
+    # every tune has its own random stream so a run can be reproduced with any number of workers
+    rng = random.Random(seed)
+
+    number = rng.randint(3, 5)
+    parts = rng.choices(instr_list, k=number)
+    spices = [round(rng.uniform(0, 1), 3) for _ in range(number)]
+    micro_percs = [rng.uniform(0.2, 0.3) for _ in range(number)]
+    seeds = [rng.randrange(2**32) for _ in range(2*number + 1)]
+    return number, parts, spices, micro_percs, seeds
 
-for i in instr_list:
-    os.makedirs(f'{midi_output_dir}/{i}')
 
-st = time.time()
+def part_files_of(file, tempo, seed, tmp_dir, midi_output_dir):
+    """The part files make_tune generates for a tune."""
+    number, parts, spices, _, _ = arrange(seed)
+    return [f'{midi_output_dir}/{parts[i]}/{abc_spicer.part_name(f"{tmp_dir}/{file}", parts[i], spices[i], tempo)}'
+            for i in range(number)]
 
-tempo = 112
 
-# for each file
-for file in files:
+def make_tune(file, tempo, seed, input_dir, tmp_dir, midi_output_dir, stomp_output_dir, keep_intermediate=False):
+    """
+    Generate the ornamented, microtimed parts and the stomps for one tune.
+    The stages hand the tune to each other in memory, only the parts and the stomps are written
+    (and the repeated and ornamented tunes in `tmp_dir` with `keep_intermediate`).
+    Returns the tune, its part files, its stomp file and the note arrays of the parts generated, for the renderer.
+    """
 
-    # random arrangement
-    number = random.randint(3, 5)
-    parts = random.choices(instr_list, k=number)
-    spices = [round(random.uniform(0, 1), 3) for _ in range(number)]
-    tempo += 8
+    number, parts, spices, micro_percs, seeds = arrange(seed)
+    src = f'{input_dir}/{file}'
 
-    # spice abc
-    print(file)
+    # every output is built from the source, with the parameters of all the stages in between
+    part_params = [{'n': 3, 'spice': spices[i], 'tempo': tempo, 'seed': seeds[i],
+                    'micro': micro_percs[i], 'micro_seed': seeds[number + i], 'micro_rng': 'numpy'} for i in range(number)]
+    part_files = [f'{midi_output_dir}/{parts[i]}/{abc_spicer.part_name(src, parts[i], spices[i], tempo)}'
+                  for i in range(number)]
+    stomp_file = f'{stomp_output_dir}/{stomping.stomp_name(src, tempo)}'
+    stomp_params = {'n': 3, 'tempo': tempo, 'seed': seeds[-1]}
+
+    todo = [i for i in range(number) if not deps.up_to_date(part_files[i], [src], part_params[i])]
+    stomps_done = deps.up_to_date(stomp_file, [src], stomp_params)
     for i in range(number):
-        print(f'Generating part {i}: {parts[i]} with spice {spices[i]}')
-        repeat_midi.main(f'{input_dir}/{file}', 3, f'{tmp_dir}/{file}')
-        abc_spicer.main(f'{tmp_dir}/{file}', parts[i], spices[i], tempo, f'{midi_output_dir}/{parts[i]}')
-        if i == number-1:
-            # generate stomps
-            print('Generating stomps')
-            stomping.main(f'{tmp_dir}/{file}', tempo, stomp_output_dir)
-    print()
+        if i not in todo:
+            print(f'{os.path.basename(part_files[i])} is up to date')
+    if stomps_done:
+        print(f'{os.path.basename(stomp_file)} is up to date')
+    if not todo and stomps_done:
+        return file, part_files, stomp_file, {}
+
+    # repeat once, the repeated tune is then shared by all parts
+    print(f'{file} (seed {seed})')
+    with metrics.stage('repeat_midi', file, file):
+        repeated = repeat_midi.repeat(pretty_midi.PrettyMIDI(src), 3)
+        # the tune as the spicer would read it from a file, never written
+        repeated = tune_cache.encode(repeated)
+    if keep_intermediate:
+        with open(f'{tmp_dir}/{file}', 'wb') as f:
+            f.write(repeated)
+
+    # generate stomps
+    if not stomps_done:
+        print(f'{file}: generating stomps')
+        random.seed(seeds[-1])
+        stomping.write_stomps(tune_cache.metadata(repeated), tempo, stomp_file)
+        deps.record(stomp_file, [src], stomp_params)
+
+    # spice every part from the repeated tune
+    spiced = []
+    for i in todo:
+        name = os.path.basename(part_files[i])
+
+        print(f'{file}: generating part {i}: {parts[i]} with spice {spices[i]}')
+        random.seed(seeds[i])
+        with metrics.stage('abc_spicer', file, name):
+            part = abc_spicer.to_midi(abc_spicer.ornament(abc_spicer.read_tune(repeated), parts[i], spices[i]), int(tempo))
+        if keep_intermediate:
+            os.makedirs(f'{tmp_dir}/{parts[i]}', exist_ok=True)
+            part.write(f'{tmp_dir}/{parts[i]}/{name}')
+        spiced.append(part)
+
+    # then microtime all of them at once, each part with its own generator
+    # (nothing to do when only the stomps were out of date)
+    if todo:
+        for i in todo:
+            print(f'Generating micro timings for {os.path.basename(part_files[i])} ({micro_percs[i]*100}%)')
+        with metrics.stage('microtiming', file, file):
+            microtiming.microtime_tunes(spiced, [micro_percs[i] for i in todo],
+                                        [np.random.default_rng(seeds[number + i]) for i in todo])
+
+    notes = {}
+    for i, part in zip(todo, spiced):
+        data = tune_cache.encode(part)
+        with open(part_files[i], 'wb') as f:
+            f.write(data)
+        deps.record(part_files[i], [src], part_params[i])
+        # the notes as written, on the tick grid, so the render is the same as from the file
+        notes[f'{parts[i]}/{os.path.basename(part_files[i])}'] = load_midi.note_arrays(pretty_midi.PrettyMIDI(io.BytesIO(data)))
+
+    return file, part_files, stomp_file, notes
+
+
+def stem_file(part_file, audio_output_dir):
+    # the renderer writes <audio>/<instrument>/<part>_generated_performance.wav
+    return f'{audio_output_dir}/{os.path.basename(os.path.dirname(part_file))}/{os.path.basename(part_file)}_generated_performance.wav'
+
+
+def prune(folder, keep):
+    """Remove the artifacts of a folder that are not in `keep`, left over from an earlier arrangement."""
+    for f in deps.listdir(folder):
+        path = f'{folder}/{f}'
+        if path not in keep:
+            print(f'Removing stale {path}')
+            deps.remove(path)
+
+
+# the renderer of this process, kept between the batches of the pipeline
+_renderer = None
+
+def render(midi_output_dir, audio_output_dir, queue_dir=None, reuse=False, files=None, notes=None):
+    """
+    Render the midi parts that changed since their stem was rendered (only `files` if given),
+    in this process or through a running `midi_render.py --serve` worker.
+    In this process, the parts in `notes` are rendered from their note arrays instead of their file.
+    """
+
+    if queue_dir is not None:
+        job_id = render_queue.submit(queue_dir, midi_output_dir, audio_output_dir, incremental=True, files=files)
+        print(f'Submitted render job {job_id} to {queue_dir}')
+        render_queue.wait(queue_dir, job_id)
+        return
+
+    # imported here so that the symbolic workers never load tensorflow
+    global _renderer
+    if _renderer is None:
+        import midi_render
+        _renderer = midi_render.Renderer(cache=midi_render.RenderCache() if reuse else None)
+    _renderer.render_dir(midi_output_dir, audio_output_dir, incremental=True, files=files, notes=notes)
+
+
+###### pipeline ######
+
+# Tunes flow through three stages running at the same time: the symbolic stages in a process pool,
+# the rendering in this process and the mixing in another process pool.
+# The stages are connected by bounded queues, None marks the end of the stream.
+# The worker processes are started from a fork server, not forked from this process,
+# which imports tensorflow and holds the models once rendering has started.
+MP_CONTEXT = 'forkserver'
+
+def put(q, item, stop):
+    # a stage blocked on a full queue gives up once another stage failed
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+
+def get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def symbolic_stage(tasks, workers, render_q, stop):
+    """Generate the tunes, each one goes to the render queue as soon as its parts are microtimed."""
+    tasks = iter(tasks)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(MP_CONTEXT)) as pool:
+        pending = {}
+        while not stop.is_set():
+            # at most `workers` tunes in flight, the queue holds the ones waiting for rendering
+            for task in itertools.islice(tasks, workers - len(pending)):
+                pending[pool.submit(make_tune, *task)] = task[0]
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                del pending[future]
+                put(render_q, future.result(), stop)
+
+    put(render_q, None, stop)
+
+
+def render_stage(render_q, mix_q, midi_output_dir, audio_output_dir, queue_dir, reuse, stop):
+    """Render the tunes waiting in the queue together, so they share the model batches."""
+    finished = False
+    while not finished:
+        tunes = [get(render_q, stop)]
+        while True:
+            try:
+                tunes.append(render_q.get_nowait())
+            except queue.Empty:
+                break
+
+        finished = None in tunes
+        tunes = [t for t in tunes if t is not None]
+        if not tunes:
+            continue
+
+        files = [os.path.relpath(p, midi_output_dir) for _, part_files, _, _ in tunes for p in part_files]
+        notes = {k: v for _, _, _, tune_notes in tunes for k, v in tune_notes.items()}
+        print(f'Rendering {len(files)} parts of {", ".join(file for file, _, _, _ in tunes)}')
+        render(midi_output_dir, audio_output_dir, queue_dir, reuse, files, notes)
+
+        # the stems of each tune go to the mixer as they are, whatever the tune is named
+        for file, part_files, stomp_file, _ in tunes:
+            put(mix_q, (file, [stem_file(p, audio_output_dir) for p in part_files], stomp_file), stop)
+
+    put(mix_q, None, stop)
+
+
+def mix_stage(mix_q, workers, audio_output_dir, song_output_dir, seed, stop):
+    """Mix every tune as soon as all its stems are rendered."""
+    os.makedirs(song_output_dir, exist_ok=True)
+
+    def record(futures, done):
+        # each song is recorded as soon as it is mixed, so an interrupted run keeps the finished ones
+        for future in done:
+            future.result()
+            task = futures.pop(future)
+            deps.record(*mixer.mix_inputs(task))
+            print(f'{task[0]} mixed')
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(MP_CONTEXT)) as pool:
+        futures = {}
+        while not stop.is_set():
+            record(futures, [future for future in futures if future.done()])
+            try:
+                song = mix_q.get(timeout=1)
+            except queue.Empty:
+                continue
+            if song is None:
+                break
+
+            file, stems, stomp_file = song
+            task = mixer.song_task(file, stems, stomp_file, False, song_output_dir, seed)
+            if deps.up_to_date(*mixer.mix_inputs(task)):
+                print(f'{file} is up to date')
+            else:
+                futures[pool.submit(mixer.mix_song, *task)] = task
+
+        record(futures, as_completed(list(futures)))
+
+
+def run_pipeline(tasks, args, seed, midi_output_dir, audio_output_dir, song_output_dir):
+    render_q = queue.Queue(maxsize=args.queue_size)
+    mix_q = queue.Queue(maxsize=args.queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def run(stage, *stage_args):
+        try:
+            stage(*stage_args, stop)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    # the fork server starts now, while this process has not imported tensorflow yet
+    multiprocessing.forkserver.ensure_running()
+
+    threads = [
+        threading.Thread(target=run, args=(symbolic_stage, tasks, args.workers, render_q)),
+        threading.Thread(target=run, args=(mix_stage, mix_q, args.mix_workers or args.workers,
+                                           audio_output_dir, song_output_dir, seed)),
+    ]
+    for t in threads:
+        t.start()
+
+    # tensorflow stays in the main thread
+    run(render_stage, render_q, mix_q, midi_output_dir, audio_output_dir, args.render_queue, args.reuse)
+
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+
+def main():
+    # args
+    parser = argparse.ArgumentParser(description='Generate and render individual instrument parts for folk tunes')
+    parser.add_argument('input', help='Folder with the files to process')
+    parser.add_argument('output', help='Output folder for midi and audio')
+    parser.add_argument('--workers', type=int, default=1, help='Processes generating the symbolic parts')
+    parser.add_argument('--mix-workers', type=int, default=None, help='Processes mixing the songs (default: --workers)')
+    parser.add_argument('--queue-size', type=int, default=4, help='Tunes waiting between two stages')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for the random arrangement of the batch')
+    parser.add_argument('--render-queue', default=None, help='Queue folder of a running midi_render.py --serve worker')
+    parser.add_argument('--reuse', action='store_true', help='Reuse cached renders of unchanged parts')
+    parser.add_argument('--keep-intermediate', action='store_true',
+                        help='Also write the repeated and ornamented tunes to the tmp folder, for debugging')
+    parser.add_argument('--clean', action='store_true', help='Remove the intermediate files once the run is complete')
+    parser.add_argument('--metrics', default=None, help='Record the time, memory and io of every stage to this json lines file')
+    parser.add_argument('--prometheus', default=None, help='Write the stage totals of --metrics as a Prometheus text file')
+    parser.add_argument('--profile', choices=['cprofile', 'pyinstrument'], default=None,
+                        help='Profile every stage, the profiles go to $FOLKRNN_PROFILE_DIR (default ./profiles)')
+    args = parser.parse_args()
+
+    # set before the workers start, so they record too
+    if args.metrics is not None:
+        os.environ[metrics.METRICS_ENV] = os.path.abspath(args.metrics)
+    if args.profile is not None:
+        os.environ[metrics.PROFILE_ENV] = args.profile
+
+    # dirs
+    input_dir = args.input
+    files = sorted(os.listdir(input_dir))
+    output_dir = os.path.abspath(args.output)
+
+    midi_output_dir = f'{output_dir}/midi'
+    audio_output_dir = f'{output_dir}/audio'
+    song_output_dir = f'{output_dir}/songs'
+    stomp_output_dir = f'{audio_output_dir}/stomps'
+    tmp_dir = f'{output_dir}/tmp'
+
+    # existing artifacts are kept and only rebuilt when out of date
+    if args.keep_intermediate:
+        os.makedirs(tmp_dir, exist_ok=True)
+
+    for i in instr_list:
+        os.makedirs(f'{midi_output_dir}/{i}', exist_ok=True)
+        os.makedirs(f'{audio_output_dir}/{i}', exist_ok=True)
+    os.makedirs(stomp_output_dir, exist_ok=True)
+
+    # a re-run without --seed resumes the previous run
+    run_file = f'{output_dir}/{deps.DEPS_DIR}/run.json'
+    seed = args.seed
+    if seed is None and os.path.exists(run_file):
+        with open(run_file) as f:
+            seed = json.load(f)['seed']
+    if seed is None:
+        seed = random.randrange(2**32)
+    print(f'Seed: {seed}')
+
+    os.makedirs(os.path.dirname(run_file), exist_ok=True)
+    with open(run_file, 'w') as f:
+        json.dump({'seed': seed}, f)
+
+    # per-tune seeds and tempos
+    rng = random.Random(seed)
+    seeds = [rng.randrange(2**32) for _ in files]
+    tempos = [112 + 8*(i+1) for i in range(len(files))]
 
-# microtiming
-for i in instr_list:
-    files_to_micro = os.listdir(f'{midi_output_dir}/{i}')
-    for file in files_to_micro:
-        micro_perc = random.uniform(0.2, 0.3)
-        print(f'Generating micro timings for {file} ({micro_perc*100}%)')
-        microtiming.main(f'{midi_output_dir}/{i}/{file}', micro_perc, f'{midi_output_dir}/{i}/{file}')
-print()
+    st = time.time()
 
-# render with control-synthesis
-os.system(f'cd render && python3 midi_render.py {midi_output_dir} {audio_output_dir}')
+    tasks = [(file, tempos[i], seeds[i], input_dir, tmp_dir, midi_output_dir, stomp_output_dir, args.keep_intermediate)
+             for i, file in enumerate(files)]
 
-# mix all tracks
-mixer.main(audio_output_dir, False, True, song_output_dir)
+    # parts of another arrangement (e.g. a different seed) would be rendered and mixed too
+    part_files = {p for i, file in enumerate(files)
+                  for p in part_files_of(file, tempos[i], seeds[i], tmp_dir, midi_output_dir)}
+    stems = {stem_file(p, audio_output_dir) for p in part_files}
+    for i in instr_list:
+        prune(f'{midi_output_dir}/{i}', part_files)
+        prune(f'{audio_output_dir}/{i}', stems)
+    prune(stomp_output_dir, {f'{stomp_output_dir}/{stomping.stomp_name(file, tempos[i])}' for i, file in enumerate(files)})
 
-et = time.time()-st
+    # generate, render with control-synthesis and mix, tune by tune
+    run_pipeline(tasks, args, seed, midi_output_dir, audio_output_dir, song_output_dir)
 
-os.system(f'rm -fr {tmp_dir}')
+    et = time.time()-st
 
-print(f'Generation of {len(files)} songs took {et} seconds ({et/len(files)} per file).')
+    # the intermediate files (--keep-intermediate) are only written for debugging
+    if args.clean and os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
 
+    print(f'Generation of {len(files)} songs took {et} seconds ({et/len(files)} per file).')
 
+    if args.metrics is not None and os.path.exists(args.metrics):
+        metrics.main(args.metrics, args.prometheus)
 
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import os
+import json
+
+# Manifests recording what each pipeline artifact was built from.
+# The manifest of `<dir>/<name>` is `<dir>/.deps/<name>.json`, it holds the size and mtime
+# of the artifact and of its inputs, and the parameters of the stage that built it.
+# An artifact is up to date when it still matches its manifest, so a re-run only
+# rebuilds what is missing, was interrupted or depends on something that changed.
+
+DEPS_DIR = '.deps'
+
+
+def manifest_path(output):
+    return f'{os.path.dirname(output)}/{DEPS_DIR}/{os.path.basename(output)}.json'
+
+
+def stat(file):
+    st = os.stat(file)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def signature(output, inputs, params):
+    return {
+        'output': stat(output),
+        'inputs': {os.path.abspath(f): stat(f) for f in inputs},
+        'params': params,
+    }
+
+
+def up_to_date(output, inputs, params=None):
+    """True if `output` was built from the current `inputs` with the same `params`."""
+    path = manifest_path(output)
+    if not os.path.exists(output) or not os.path.exists(path):
+        return False
+
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+        # round trip through json, so tuples and lists compare equal
+        return manifest == json.loads(json.dumps(signature(output, inputs, params)))
+    except (ValueError, FileNotFoundError):
+        return False
+
+
+def record(output, inputs, params=None):
+    """Write the manifest of a freshly built `output`."""
+    path = manifest_path(output)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(signature(output, inputs, params), f)
+    os.replace(tmp, path)
+
+
+def remove(output):
+    """Delete an artifact and its manifest."""
+    for f in [output, manifest_path(output)]:
+        if os.path.exists(f):
+            os.remove(f)
+
+
+def listdir(folder):
+    """Artifacts of a folder, without the manifests."""
+    return [f for f in os.listdir(folder) if f != DEPS_DIR]
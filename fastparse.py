@@ -0,0 +1,242 @@
+import math
+import argparse
+from fractions import Fraction
+import mido
+
+# Reads the monophonic midi tunes of the pipeline into bars of notes, without music21.
+# The notes come out as music21 parses them: offsets and durations quantized to sixteenths
+# and eighth triplets, put in bars of the time signature and split at the bar lines.
+# Files outside of that subset (chords, several voices or tracks, meter changes...)
+# raise Unsupported, and are left to music21.
+
+# music21's quantization grid and largest denominator of an offset
+DIVISORS = (4, 3)
+DENOM_LIMIT = 65535
+
+
+class Unsupported(Exception):
+    pass
+
+
+###### music21 arithmetic ######
+
+def op_frac(x):
+    # a quarter length as music21 stores it, a float if exact in binary, otherwise a fraction
+    if isinstance(x, Fraction):
+        return x.numerator/x.denominator if x.denominator & (x.denominator - 1) == 0 else x
+    n, d = float(x).as_integer_ratio()
+    return Fraction(n, d).limit_denominator(DENOM_LIMIT) if d > DENOM_LIMIT else float(x)
+
+
+def nearest_multiple(n, unit):
+    # (match, error), rounded and compared on floats as music21 does
+    mult = math.floor(n/unit)
+    low = unit*mult
+    if low <= n <= low + unit/2:
+        return low, round(n - low, 7)
+    high = unit*(mult + 1)
+    return high, round(high - n, 7)
+
+
+def best_match(target, divisors=DIVISORS):
+    """Nearest grid point as (match, divisor), the smallest error then the finest grid wins."""
+    found = []
+    for div in divisors:
+        match, error = nearest_multiple(target, 1/div)
+        found.append((error, 1/div, match, div))
+    _, _, match, div = min(found)
+    return match, div
+
+
+def quantize(notes, ticks_per_quarter):
+    """Offsets and durations of (on, off, pitch) notes on the grid, music21's Stream.quantize."""
+    raw = [(float(op_frac(on/ticks_per_quarter)), float(op_frac((off - on)/ticks_per_quarter)), pitch)
+           for on, off, pitch in notes]
+
+    quantized = []
+    for i, (o, ql, pitch) in enumerate(raw):
+        offset = op_frac(best_match(o)[0])
+        duration, _ = best_match(ql)
+
+        if i + 1 < len(raw):
+            # no gap to the next note smaller than a sixteenth, use the grid of the next note
+            next_offset, next_div = best_match(raw[i+1][0])
+            if 0 < next_offset - (offset + duration) < 1/max(DIVISORS):
+                duration, _ = best_match(ql, (next_div,))
+
+        duration = 1/max(DIVISORS) if duration == 0 else op_frac(duration)
+        quantized.append((pitch, Fraction(offset), Fraction(duration)))
+
+    return quantized
+
+
+###### midi ######
+
+def read_events(file):
+    """Ticks per quarter, conductor events and note events of the single note track of a path or file object."""
+    midi = mido.MidiFile(file) if isinstance(file, str) else mido.MidiFile(file=file)
+    if midi.type != 1 or len(midi.tracks) < 2:
+        raise Unsupported('not a multi-track midi file')
+
+    tracks = []
+    for track in midi.tracks:
+        t = 0
+        events = []
+        for msg in track:
+            t += msg.time
+            events.append((t, msg))
+        tracks.append(events)
+
+    conductor, *parts = tracks
+    parts = [p for p in parts if any(msg.type == 'note_on' for _, msg in p)]
+    if any(msg.type == 'note_on' for _, msg in conductor) or len(parts) != 1:
+        raise Unsupported('not a single note track')
+
+    for t, msg in conductor + parts[0]:
+        if t > 0 and msg.type not in ('note_on', 'note_off', 'end_of_track'):
+            raise Unsupported(f'{msg.type} event after the start')
+
+    return midi.ticks_per_beat, conductor, parts[0]
+
+
+def pair_notes(events):
+    """(on, off, pitch) of every note, each note on closed by the next note off of its pitch and channel."""
+    notes = []
+    used = set()
+    for i, (t, msg) in enumerate(events):
+        if msg.type != 'note_on' or msg.velocity == 0:
+            continue
+        if msg.channel == 9:
+            raise Unsupported('percussion channel')
+
+        for j in range(i + 1, len(events)):
+            t_off, off = events[j]
+            if (j not in used and off.type in ('note_on', 'note_off') and (off.type == 'note_off' or off.velocity == 0)
+                    and off.note == msg.note and off.channel == msg.channel):
+                used.add(j)
+                notes.append((t, t_off, msg.note))
+                break
+
+    return notes
+
+
+def key_tonic(conductor):
+    """Pitch class of the tonic of the first key signature, None if there is none."""
+    for _, msg in conductor:
+        if msg.type == 'key_signature':
+            # mido names the key (e.g. 'F#m'), only its pitch class matters
+            name = msg.key[:-1] if msg.key.endswith('m') else msg.key
+            pc = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}[name[0]]
+            return (pc + {'#': 1, 'b': -1}.get(name[1:], 0)) % 12
+    return None
+
+
+def bar_duration(conductor):
+    signatures = {(msg.numerator, msg.denominator) for _, msg in conductor if msg.type == 'time_signature'}
+    if len(signatures) > 1:
+        raise Unsupported('meter changes')
+    # music21's default is 4/4
+    numerator, denominator = signatures.pop() if signatures else (4, 4)
+    return Fraction(4*numerator, denominator)
+
+
+###### bars ######
+
+def make_bars(notes, bar_length):
+    """
+    Bars of (offset, duration, notes), music21's makeMeasures and makeTies on quantized notes.
+    The notes are (pitch, offset in the bar, duration, tie), the tie as music21's type
+    ('start', 'continue', 'stop') for the parts of a note split at bar lines, otherwise None.
+    """
+    for (_, offset, _), (_, next_offset, _) in zip(notes, notes[1:]):
+        if next_offset <= offset:
+            raise Unsupported('notes out of order')
+
+    # as many bars as needed to reach the end of the longest note
+    end = max(offset + duration for _, offset, duration in notes)
+    count = max(1, math.ceil(end/bar_length))
+    bars = [(op_frac(i*bar_length), op_frac(bar_length), []) for i in range(count)]
+
+    for pitch, offset, duration in notes:
+        i = int(offset // bar_length)
+        bars[i][2].append((pitch, offset - i*bar_length, duration, None))
+
+    # notes longer than their bar are tied to a note at the start of the next one,
+    # which comes after the notes starting there
+    for i, (_, _, bar_notes) in enumerate(bars):
+        bar_notes.sort(key=lambda n: n[1])
+        for k, (pitch, start, duration, tie) in enumerate(bar_notes):
+            if start + duration > bar_length:
+                bar_notes[k] = (pitch, start, bar_length - start, 'start' if tie is None else 'continue')
+                bars[i+1][2].append((pitch, Fraction(0), start + duration - bar_length, 'stop'))
+
+    return [(o, d, [(pitch, op_frac(start), op_frac(duration), tie) for pitch, start, duration, tie in bar_notes])
+            for o, d, bar_notes in bars]
+
+
+def read(file):
+    """
+    Bars of a monophonic midi tune (a path or binary file) without music21, as a dict with `tonic` (pitch class of the key
+    signature, None without one), `bar_duration` and `bars`, a list of (offset, duration, notes),
+    the notes as (midi pitch, offset in the bar, duration, tie), all in quarter lengths (see make_bars).
+    Raises Unsupported for files music21 has to parse.
+    """
+    try:
+        ticks_per_quarter, conductor, events = read_events(file)
+    except (OSError, ValueError, EOFError) as e:
+        raise Unsupported(str(e))
+
+    notes = pair_notes(events)
+    if not notes:
+        raise Unsupported('no notes')
+
+    # music21 makes chords, or voices, of notes starting closer than the grid
+    tolerance = ticks_per_quarter/max(DIVISORS)
+    for (on, _, _), (next_on, _, _) in zip(notes, notes[1:]):
+        if abs(next_on - on) < tolerance:
+            raise Unsupported('chords')
+
+    bar_length = bar_duration(conductor)
+    return {
+        'tonic': key_tonic(conductor),
+        'bar_duration': op_frac(bar_length),
+        'bars': make_bars(quantize(notes, ticks_per_quarter), bar_length),
+    }
+
+
+###### parity ######
+
+def check(files):
+    """Compare the bars read here and by music21, returns the files that differ."""
+    import tune_cache
+
+    different = []
+    for file in files:
+        try:
+            fast = read(file)
+        except Unsupported as e:
+            print(f'{file}: unsupported ({e})')
+            continue
+
+        slow = tune_cache.from_music21(tune_cache.parse(file))
+        if fast['tonic'] is None:
+            fast['tonic'] = slow['tonic']
+
+        if fast == slow:
+            print(f'{file}: ok')
+        else:
+            different.append(file)
+            print(f'{file}: DIFFERENT')
+            for k in fast:
+                if fast[k] != slow[k]:
+                    print(f'  {k}: {fast[k]} != {slow[k]}')
+
+    return different
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the fast midi reader against music21')
+    parser.add_argument('files', nargs='+', help='midi tunes')
+    args = parser.parse_args()
+    if check(args.files):
+        raise SystemExit(1)
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import argparse
+import resource
+import functools
+import contextlib
+
+# Per-stage metrics: wall time, cpu time, peak rss and bytes read/written, per stage and tune.
+# Recording is off unless $FOLKRNN_METRICS names a json lines file, one line per stage run.
+# The variables are read at every call, so they can be set by a script before its workers start.
+# $FOLKRNN_PROFILE=cprofile|pyinstrument also profiles every stage into $FOLKRNN_PROFILE_DIR.
+
+METRICS_ENV = 'FOLKRNN_METRICS'
+PROFILE_ENV = 'FOLKRNN_PROFILE'
+PROFILE_DIR_ENV = 'FOLKRNN_PROFILE_DIR'
+
+FIELDS = ['wall', 'cpu', 'read_bytes', 'write_bytes', 'peak_rss']
+
+
+def io_counters():
+    """Bytes read and written by this process (all reads and writes, cached or not)."""
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                k, v = line.split(':')
+                counters[k] = int(v)
+    except OSError:
+        pass
+    return counters.get('rchar', 0), counters.get('wchar', 0)
+
+
+def peak_rss():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+
+def profiler(name, tune):
+    """Start the profiler chosen in $FOLKRNN_PROFILE, returns a function stopping it and saving the profile."""
+    kind = os.environ.get(PROFILE_ENV)
+    if not kind:
+        return None
+
+    folder = os.environ.get(PROFILE_DIR_ENV, './profiles')
+    os.makedirs(folder, exist_ok=True)
+    path = f'{folder}/{name}_{tune}_{os.getpid()}_{time.time_ns()}'
+
+    if kind == 'pyinstrument':
+        import pyinstrument
+        p = pyinstrument.Profiler()
+        p.start()
+
+        def stop():
+            p.stop()
+            with open(f'{path}.html', 'w') as f:
+                f.write(p.output_html())
+        return stop
+
+    import cProfile
+    p = cProfile.Profile()
+    p.enable()
+
+    def stop():
+        p.disable()
+        p.dump_stats(f'{path}.prof')
+    return stop
+
+
+def write(record):
+    # one write per line on a file opened in append mode, so several processes can share it
+    with open(os.environ[METRICS_ENV], 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def tune_of(file):
+    # parts and stems are named <tune>_<instrument>_...
+    return file.split('_')[0]
+
+
+@contextlib.contextmanager
+def stage(name, tune=None, file=None, batch=None):
+    """
+    Measure the enclosed block as one run of `name` for `tune` (and the part or stem `file`).
+    For a block working on a `batch` of files, the measurement is divided evenly between them,
+    one record per file.
+    """
+    if not os.environ.get(METRICS_ENV) and not os.environ.get(PROFILE_ENV):
+        yield
+        return
+
+    stop = profiler(name, tune if batch is None else tune_of(batch[0]))
+    read, written = io_counters()
+    st = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - st
+        cpu = time.process_time() - cpu
+        if stop is not None:
+            stop()
+
+        if os.environ.get(METRICS_ENV):
+            end_read, end_written = io_counters()
+            files = [(tune, file)] if batch is None else [(tune_of(f), f) for f in batch]
+            for tune, file in files:
+                record = {
+                    'stage': name,
+                    'tune': tune,
+                    'file': file,
+                    'pid': os.getpid(),
+                    'time': time.time(),
+                    'wall': wall/len(files),
+                    # of the whole process, including the threads of other stages
+                    'cpu': cpu/len(files),
+                    'read_bytes': (end_read - read)/len(files),
+                    'write_bytes': (end_written - written)/len(files),
+                    # high-water mark of the process so far
+                    'peak_rss': peak_rss(),
+                }
+                if batch is not None:
+                    record['batch'] = len(batch)
+                write(record)
+
+
+def measured(name, tune_arg=None):
+    """
+    Decorator measuring every call as a stage, for the file named by the argument at `tune_arg`,
+    or for each of the files if it is a list of names (a batch).
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            arg = args[tune_arg] if tune_arg is not None and len(args) > tune_arg else None
+            if isinstance(arg, str):
+                file = os.path.basename(arg)
+                measure = stage(name, tune_of(file), file)
+            elif isinstance(arg, (list, tuple)) and arg and all(isinstance(a, str) for a in arg):
+                measure = stage(name, batch=[os.path.basename(a) for a in arg])
+            else:
+                measure = stage(name)
+            with measure:
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+###### reports ######
+
+def read(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def totals(records, key):
+    """Runs, wall, cpu and bytes read/written summed over the records sharing a key, and the largest peak rss."""
+    groups = {}
+    for r in records:
+        s = groups.setdefault(key(r), {'runs': 0, **{k: 0 for k in FIELDS}})
+        s['runs'] += 1
+        for k in FIELDS:
+            s[k] = max(s[k], r[k]) if k == 'peak_rss' else s[k] + r[k]
+    return groups
+
+
+def prometheus(records):
+    """Prometheus text exposition of the totals per stage and tune."""
+    series = totals(records, lambda r: (r['stage'], r['tune'] or ''))
+
+    metrics = [
+        ('runs', 'folkrnn_stage_runs_total', 'counter', 'Runs of the stage'),
+        ('wall', 'folkrnn_stage_wall_seconds_total', 'counter', 'Wall time spent in the stage'),
+        ('cpu', 'folkrnn_stage_cpu_seconds_total', 'counter', 'Process cpu time spent in the stage'),
+        ('read_bytes', 'folkrnn_stage_read_bytes_total', 'counter', 'Bytes read during the stage'),
+        ('write_bytes', 'folkrnn_stage_write_bytes_total', 'counter', 'Bytes written during the stage'),
+        ('peak_rss', 'folkrnn_stage_peak_rss_bytes', 'gauge', 'Largest peak resident memory of a process running the stage'),
+    ]
+
+    lines = []
+    for k, metric, kind, help in metrics:
+        lines.append(f'# HELP {metric} {help}')
+        lines.append(f'# TYPE {metric} {kind}')
+        for (name, tune), s in sorted(series.items()):
+            lines.append(f'{metric}{{stage="{name}",tune="{tune}"}} {s[k]}')
+    return '\n'.join(lines) + '\n'
+
+
+def main(path, prometheus_file=None):
+    records = read(path)
+
+    print(f'{"stage":24s} {"runs":>6s} {"wall (s)":>10s} {"cpu (s)":>10s} {"read (MB)":>10s} {"written (MB)":>12s} {"peak rss (MB)":>14s}')
+    for name, s in sorted(totals(records, lambda r: r['stage']).items(), key=lambda x: -x[1]['wall']):
+        print(f'{name:24s} {s["runs"]:6d} {s["wall"]:10.2f} {s["cpu"]:10.2f} '
+              f'{s["read_bytes"]/2**20:10.1f} {s["write_bytes"]/2**20:12.1f} {s["peak_rss"]/2**20:14.1f}')
+
+    if prometheus_file is not None:
+        with open(prometheus_file, 'w') as f:
+            f.write(prometheus(records))
+        print(f'Prometheus metrics written to {prometheus_file}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the stage metrics of a run')
+    parser.add_argument('metrics', help=f'json lines file written with ${METRICS_ENV}')
+    parser.add_argument('--prometheus', default=None, help='also write the totals as a Prometheus text file')
+    args = parser.parse_args()
+    main(args.metrics, args.prometheus)
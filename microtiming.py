@@ -1,46 +1,115 @@
 import argparse
 import random
+import numpy as np
 import pretty_midi
+import metrics
 
-def main(file, micro, output):
-    # open file
-    tune = pretty_midi.PrettyMIDI(file)
+# Microtiming works on note arrays (pitch, velocity, start, end), ordered by onset,
+# and on many parts at once: the parts are concatenated and every note only looks at the previous
+# note of its own part. Each part draws from its own generator, so it gets the same timing
+# whatever it is batched with.
+
+
+def note_arrays(instrument):
+    """Pitch, velocity, start and end arrays of the notes of a pretty_midi instrument, in their order."""
+    notes = instrument.notes
+    return (np.fromiter((n.pitch for n in notes), dtype=np.float32, count=len(notes)),
+            np.fromiter((n.velocity for n in notes), dtype=np.float32, count=len(notes)),
+            np.fromiter((n.start for n in notes), dtype=np.float64, count=len(notes)),
+            np.fromiter((n.end for n in notes), dtype=np.float64, count=len(notes)))
+
+
+def set_notes(instrument, notes):
+    pitch, velocity, start, end = (a.tolist() for a in notes)
+    instrument.notes = [pretty_midi.Note(velocity=int(v), pitch=int(p), start=s, end=e)
+                        for p, v, s, e in zip(pitch, velocity, start, end)]
+
+
+def microtime_batch(parts, micros, rngs):
+    """
+    Microtime many parts at once, each one by its own amount (a fraction of the note durations)
+    and with its own numpy generator. Returns the microtimed note arrays of every part, without
+    the notes that ended up empty.
+    """
+    if not parts:
+        return []
+
+    sizes = np.array([len(p[0]) for p in parts])
+    pitch, velocity, start, end = (np.concatenate([p[k] for p in parts]) for k in range(4))
+    micro = np.repeat(np.asarray(micros, dtype=np.float64), sizes)
 
-    shift_perc = float(micro)
+    # first and last note of every part
+    ends = np.cumsum(sizes)
+    first = np.zeros(len(pitch), dtype=bool)
+    first[(ends - sizes)[sizes > 0]] = True
+    last = ends[sizes > 0] - 1
 
-    # for each instrument in the file
-    for instrument in tune.instruments:
-        prev_note_end = 0
-        prev_note = instrument.notes[0]
+    # all the random draws of a part at once
+    draws = [(rng.random((4, size)), rng.integers(-7, 8, size)) for rng, size in zip(rngs, sizes)]
+    change, jump, start_shift, end_shift = np.concatenate([d for d, _ in draws], axis=1)
+    steps = np.concatenate([s for _, s in draws])
 
-        for note in instrument.notes:
+    # randomly change pitch sometimes: a jump of a few semitones, or the pitch of the previous note
+    change = change < 0.1*micro
+    pitch = pitch + np.where(change & (jump < 0.5), steps, 0)
+    # copies of copies carry the pitch forward, the first note of a part keeps its own
+    copied = change & (jump >= 0.5) & ~first
+    pitch = pitch[np.maximum.accumulate(np.where(copied, 0, np.arange(len(pitch))))]
 
-            # randomly change pitch sometimes
-            if random.uniform(0, 1) < 0.1*micro:
-                if random.uniform(0,1) < 0.5:
-                    note.pitch += random.randint(-7, 7)
-                else:
-                    note.pitch = prev_note.pitch
+    # maximum shift delta (a fraction of the duration)
+    delta = micro*(end - start)
 
-            # calculate maximum shift delta (a fraction of the duration)
-            delta = shift_perc*(note.end - note.start)
+    # the end time moves on its own, so the end of the previous note is known for every note
+    new_end = end + (2*end_shift - 1)*delta
+    prev_end = np.concatenate([[0.0], new_end[:-1]])
+    prev_end[first] = 0.0
 
-            # if the previous note ended
-            # after the original start time,
-            # use that as new start time,
-            # else use the original one with some randomness
-            note.start = max(note.start + random.uniform(0, delta), prev_note_end)
+    # start later by some randomness, but not before the previous note ended
+    new_start = np.maximum(start + start_shift*delta, prev_end)
+    new_end[last] += 10
 
-            # randomize the note end time
-            note.end += random.uniform(-delta, delta)
+    # drop the notes that ended up empty, as pretty_midi's remove_invalid_notes
+    microtimed = []
+    for part in np.split(np.arange(len(pitch)), ends[:-1]):
+        part = part[new_end[part] > new_start[part]]
+        part = part[np.argsort(new_start[part], kind='stable')]
+        microtimed.append((pitch[part], velocity[part], new_start[part], new_end[part]))
 
-            # update for next iteration
-            prev_note_end = note.end
-            prev_note = note
+    return microtimed
 
-        instrument.notes[-1].end += 10
 
-    tune.remove_invalid_notes()
+def microtime_tunes(tunes, micros, rngs):
+    """
+    Microtime every instrument of many pretty_midi tunes in place, in one batch, each tune by up to
+    its `micro` of the note durations and with its own numpy generator.
+    """
+    instruments, part_micros, part_rngs = [], [], []
+    for tune, micro, rng in zip(tunes, micros, rngs):
+        with_notes = [i for i in tune.instruments if i.notes]
+        instruments += with_notes
+        part_micros += [float(micro)]*len(with_notes)
+        part_rngs += rng.spawn(len(with_notes))
+
+    parts = microtime_batch([note_arrays(i) for i in instruments], part_micros, part_rngs)
+    for instrument, notes in zip(instruments, parts):
+        set_notes(instrument, notes)
+    return tunes
+
+
+def microtime(tune, micro, rng=None):
+    """Microtime every instrument of a pretty_midi tune in place, by up to `micro` of the note durations."""
+    if rng is None:
+        # follows the seed of the random module, as the stages seed it
+        rng = np.random.default_rng(random.getrandbits(64))
+    return microtime_tunes([tune], [micro], [rng])[0]
+
+
+@metrics.measured('microtiming', tune_arg=0)
+def main(file, micro, output):
+    # open file
+    tune = pretty_midi.PrettyMIDI(file)
+
+    microtime(tune, micro)
 
     # save file
     tune.write(output)
@@ -53,4 +122,3 @@ if __name__ == 'main':
     parser.add_argument('output', help='the destination file')
     args = parser.parse_args()
     main(args.file, args.micro, args.output)
-
@@ -1,5 +1,6 @@
 import os
 import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import argparse
 from pedalboard import (
@@ -11,167 +12,305 @@ from pedalboard import (
     HighpassFilter
 )
 import soundfile as sf
+import assets
+import deps
+import metrics
 
+SAMPLE_RATE = 16000
 
-def main(input_dir, a, s, output_dir):
-    SAMPLE_RATE = 16000
+# frames processed at once, every stage is streamed in blocks of this size
+BLOCK_SIZE = 65536
 
-    do_ambience = bool(a)
-    do_stomps= bool(s)
+impulse_dir = './impulses'
+ambience_dir = './ambiences'
 
-    impulse_dir = './impulses'
-    ambience_dir = './ambiences'
 
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+###### processing ######
 
+def pan_audio(audio, angle):
+    cos = np.cos(angle)
+    sin = np.sin(angle)
+    left = pan_audio.const * (cos - sin) * audio
+    right = pan_audio.const * (cos + sin) * audio
+    return np.dstack((left, right))[0]
 
+pan_audio.const = np.sqrt(2)/2.0
 
-    ###### get stems ######
 
-    print('Loading files...')
+def fade_out_curve(start, n, fade_start, fade_end):
+    """Gain of a linear fade out over [fade_start, fade_end) for the frames [start, start+n)."""
+    length = fade_end - fade_start
+    pos = np.arange(start, start + n) - fade_start
+    curve = np.clip(1.0 - pos/max(length - 1, 1), 0.0, 1.0)
+    curve[pos < 0] = 1.0
+    return curve[:, None]
 
-    instruments = os.listdir(input_dir)
 
-    songs = {}
-    stomps = {}
+def make_limiter():
+    return Pedalboard([
+        Limiter()
+    ])
 
-    # get list of all stems in each instrument
-    for i in instruments:
-        folder = f'{input_dir}/{i}'
 
-        if i == 'stomps':
-            for x in os.listdir(folder):
-                key = x.split('_')[0]
-                stomps[key] =  f'{folder}/{x}'
+def make_track_effects():
+    return Pedalboard([
+        Gain(gain_db=-10),
+        Compressor(threshold_db=-20, ratio=2),
+        HighpassFilter(cutoff_frequency_hz=100)
+    ])
+
+
+# reverbs built so far in this process, the convolutions hold the whole impulse response
+_reverbs = {}
+
+def get_reverb(ir):
+    # wet only, the dry signal is mixed in by the send levels
+    if ir not in _reverbs:
+        _reverbs[ir] = Pedalboard([Convolution(assets.impulse(f'{impulse_dir}/{ir}'), 1.0)])
+    return _reverbs[ir]
+
+
+def process_blocks(board, blocks):
+    """Run blocks through a pedalboard, keeping the plugin state (reverb tails, envelopes) between blocks."""
+    board.reset()
+    for block in blocks:
+        n = len(block)
+        if n < BLOCK_SIZE:
+            # full-size blocks only, so the channel layout is never ambiguous
+            block = np.pad(block, ((0, BLOCK_SIZE - n), (0, 0)))
+        yield board(block.astype(np.float32), SAMPLE_RATE, reset=False)[:n]
+
+
+###### stems ######
+
+class Stem:
+    """
+    A mono file read block by block, panned to stereo, with its level and reverb send level.
+    `file` can also be an array of samples (e.g. a memory-mapped asset).
+    """
+
+    def __init__(self, file, angle, start=0, gain=1.0, send=1.0):
+        self.file = file
+        self.angle = angle
+        self.start = start
+        self.gain = gain
+        self.send = send
+
+    def blocks(self, frames):
+        # every stem has blocks of the same size at the same positions, shorter stems are padded with silence
+        read = 0
+        for block in self.read(frames):
+            n = min(BLOCK_SIZE, frames - read)
+            read += n
+            yield pan_audio(np.pad(block, (0, n - len(block))), self.angle)
+
+        while read < frames:
+            n = min(BLOCK_SIZE, frames - read)
+            read += n
+            yield np.zeros((n, 2))
+
+
+    def read(self, frames):
+        if isinstance(self.file, np.ndarray):
+            audio = self.file[self.start : self.start + frames]
+            for i in range(0, len(audio), BLOCK_SIZE):
+                yield audio[i : i + BLOCK_SIZE]
         else:
-            for x in os.listdir(folder):
-                key = x.split('_')[0]
+            for block in sf.blocks(self.file, blocksize=BLOCK_SIZE, start=self.start, frames=frames, always_2d=True):
+                yield block[:, 0]
 
-                if not key in songs:
-                    songs[key] = []
 
-                songs[key].append(f'{folder}/{x}')
+def song_length(stems, piece_end):
+    # the mix is as long as the first stem, cut at the calculated end
+    return min(sf.info(stems[0].file).frames - stems[0].start, piece_end)
 
-    ambiences = os.listdir(ambience_dir)
 
-    print('Done')
+def peak_pass(stem, frames):
+    """Peak of the panned stem."""
+    peak = 0.0
+    for block in stem.blocks(frames):
+        peak = max(peak, float(np.max(np.abs(block), initial=0.0)))
+    return peak
 
 
-    ###### processing ######
+def normalized_blocks(stem, frames, peak):
+    for block in stem.blocks(frames):
+        yield block/(peak or 1.0)
 
-    def pan_audio(audio, angle):
-        cos = np.cos(angle)
-        sin = np.sin(angle)
-        left = pan_audio.const * (cos - sin) * audio
-        right = pan_audio.const * (cos + sin) * audio
-        return np.dstack((left, right))[0]
 
-    pan_audio.const = np.sqrt(2)/2.0
+def mix_pass(stems, peaks, reverb, frames, fade_len, output_file):
+    """
+    Normalize and apply the track effects to every stem, then mix them
+    with a single reverb on a shared send bus, limit and fade out, one block at a time.
 
-    def normalize(audio):
-        return audio/np.max(np.abs(audio))
+    Each stem used to go through its own reverb before normalization and the track effects.
+    A shared reverb can only run on the sum of the stems, so it now comes after them:
+    the reverb tails are no longer compressed or high-passed, and the stem peaks are
+    taken before the reverb. The dry and wet levels are the former 50% convolution mix.
+    """
 
-    def fade_out(audio, secs):
-        length = int(secs*SAMPLE_RATE)
-        end = audio.shape[0]
-        start = end - length
+    # normalize each stem with the peak found in the first pass,
+    # every stem gets its own effects so their state stays separate
+    processed = [process_blocks(make_track_effects(), normalized_blocks(stem, frames, peak))
+                 for stem, peak in zip(stems, peaks)]
 
-        # compute fade out curve
-        # linear fade
-        fade_curve = np.linspace(1.0, 0.0, length)
+    # half dry and half wet, as the former per-stem 50% convolution mix
+    dry_levels = [0.5*stem.gain for stem in stems]
+    send_levels = [0.5*stem.gain*stem.send for stem in stems]
 
-        # make it stereo
-        stereo_fade = np.dstack((fade_curve, fade_curve))[0]
+    def buses():
+        for blocks in zip(*processed):
+            dry = sum(b*g for b, g in zip(blocks, dry_levels))
+            send = sum(b*g for b, g in zip(blocks, send_levels))
+            yield dry, send
 
-        # apply the curve
-        audio[start:end] = audio[start:end] * stereo_fade
+    def mixed():
+        dry_bus = []
 
-    # effects board
-    limiter = Pedalboard([
-        Limiter()
-    ], sample_rate=SAMPLE_RATE)
+        def sends():
+            for dry, send in buses():
+                dry_bus.append(dry)
+                yield send
 
-    track_effects = Pedalboard([
-        Gain(gain_db=-10),
-        Compressor(threshold_db=-20, ratio=2),
-        HighpassFilter(cutoff_frequency_hz=100)
-    ], sample_rate=SAMPLE_RATE)
+        # the reverb runs once, on the sum of the sends
+        for wet in process_blocks(reverb, sends()):
+            yield (dry_bus.pop(0) + wet)/len(stems)
 
+    # apply limiter and fade out the end
+    position = 0
+    with sf.SoundFile(output_file, 'w', samplerate=SAMPLE_RATE, channels=2) as f:
+        for block in process_blocks(make_limiter(), mixed()):
+            f.write(block*fade_out_curve(position, len(block), frames - fade_len, frames))
+            position += len(block)
 
-    # reverbs
 
-    irs = os.listdir(impulse_dir)
+@metrics.measured('mixer', tune_arg=0)
+def mix_song(tune, parts, stomp_file, ambiences, irs, output_dir, seed=None):
+    """Mix the stems of one tune into `<output_dir>/<tune>.wav`, the random choices are drawn from `seed`."""
 
-    reverbs = {i: Pedalboard([Convolution(f'{impulse_dir}/{i}', 0.5)], sample_rate=SAMPLE_RATE) for i in irs}
+    rng = random.Random(seed)
 
+    tempo = float(os.path.basename(parts[0]).split('_')[3])
+    bar_len = (60/tempo)*3
 
-    ###### songs ######
-    print('Processing...')
+    piece_end = int(bar_len*(32*3+1)*SAMPLE_RATE)
 
-    # go through each song
-    for tune in songs:
+    # generate panning
+    pans = np.radians((np.linspace(-1.0, 1.0, len(parts)))*60)
+    stems = {f'part{i}': Stem(part, pans[i]) for (i, part) in enumerate(parts)}
 
-        print(tune)
+    # ambience
+    if ambiences:
+        # only the window used is read from the mapped file
+        amb_file = assets.load(f'{ambience_dir}/{rng.choice(ambiences)}')
+        amb_start = int(rng.uniform(0, len(amb_file)-piece_end-1))
+        stems['ambience'] = Stem(amb_file, 0, start=amb_start)
 
-        tempo = float(os.path.basename(songs[tune][0]).split('_')[3])
-        bar_len = (60/tempo)*3
+    if stomp_file is not None:
+        stems['stomps'] = Stem(stomp_file, 0, gain=0.5)
 
-        piece_end = int(bar_len*(32*3+1)*SAMPLE_RATE)
+    frames = song_length(list(stems.values()), piece_end)
 
-        # load all tracks
-        # cutting at the calculated end
-        audio = {part.split('_')[2]: np.array(sf.read(part)[0][:piece_end]) for part in songs[tune]}
+    # apply random reverb
+    reverb_type = rng.choice(irs)
+    print(f'{tune}: using {reverb_type} as reverb')
 
-        # generate panning
-        pans = np.radians((np.linspace(-1.0, 1.0, len(audio)))*60)
-        audio = {a: pan_audio(audio[a], pans[i]) for (i, a) in enumerate(audio)}
+    stems = list(stems.values())
+    peaks = [peak_pass(stem, frames) for stem in stems]
 
-        # ambience
-        if do_ambience:
-            amb_file = sf.read(f'{ambience_dir}/{random.choice(ambiences)}')[0]
-            amb_start = int(random.uniform(0, len(amb_file)-piece_end-1))
-            amb_file = amb_file[amb_start : amb_start + piece_end]
-            audio['ambience'] = amb_file
+    mix_pass(stems, peaks, get_reverb(reverb_type), frames, int(bar_len*SAMPLE_RATE), f'{output_dir}/{tune}.wav')
 
-        if do_stomps:
-            audio['stomps'] = pan_audio(sf.read(stomps[tune])[0][:piece_end], 0)
 
-        # apply random reverb
-        reverb_type = random.choice(irs)
-        print(f'Using {reverb_type} as reverb')
-        for a in audio:
-            audio[a] = reverbs[reverb_type](audio[a])
+def find_stems(input_dir):
+    songs = {}
+    stomps = {}
 
-        # normalize
-        audio = {a: normalize(audio[a]) for a in audio}
+    # get list of all stems in each instrument
+    for i in os.listdir(input_dir):
+        folder = f'{input_dir}/{i}'
 
-        # apply effects
-        audio = {a: track_effects(audio[a]) for a in audio}
+        if i == 'stomps':
+            for x in deps.listdir(folder):
+                key = x.split('_')[0]
+                stomps[key] =  f'{folder}/{x}'
+        else:
+            for x in deps.listdir(folder):
+                key = x.split('_')[0]
+
+                if not key in songs:
+                    songs[key] = []
 
-        audio['stomps'] *= 0.5
+                songs[key].append(f'{folder}/{x}')
+
+    return songs, stomps
+
+
+def mix_inputs(task):
+    """Files and parameters a song is mixed from."""
+    tune, parts, stomp_file, ambiences, irs, output_dir, seed = task
+    inputs = parts + ([stomp_file] if stomp_file is not None else [])
+    return f'{output_dir}/{tune}.wav', inputs, {'ambiences': ambiences, 'irs': irs, 'seed': seed}
 
-        audio = [audio[a] for a in audio]
 
-        # mix
-        try:
-            new_audio = audio[0][:min(len(audio[0]),piece_end)]
-            for i in range(len(audio)):
-                new_audio += audio[i][:min(len(audio[i]),piece_end)]
+def song_seed(seed, tune):
+    # every song draws from its own seed, so it is mixed the same way whatever the other songs are
+    return None if seed is None else f'{seed}:{tune}'
 
-            new_audio /= len(audio)
-        except:
-            ...
 
-        # apply limiter
-        new_audio = limiter(new_audio)
+def song_task(tune, parts, stomp_file, a, output_dir, seed=None):
+    """Arguments of mix_song for one song, from its stems."""
+    ambiences = sorted(os.listdir(ambience_dir)) if a else []
+    irs = sorted(os.listdir(impulse_dir))
+    return (tune, parts, stomp_file, ambiences, irs, output_dir, song_seed(seed, tune))
 
-        # fade out the end
-        fade_out(new_audio, bar_len)
 
-        # save file
-        with sf.SoundFile(f'{output_dir}/{tune}.wav', 'w', samplerate=SAMPLE_RATE, channels=len(new_audio.shape)) as f:
-            f.write(new_audio)
+def song_tasks(input_dir, a, s, output_dir, seed=None):
+    """Arguments of mix_song for every song of `input_dir`."""
+    songs, stomps = find_stems(input_dir)
+    return [song_task(tune, songs[tune], stomps[tune] if s else None, a, output_dir, seed) for tune in sorted(songs)]
+
+
+def main(input_dir, a, s, output_dir, workers=1, seed=None, incremental=False):
+    do_ambience = bool(a)
+    do_stomps= bool(s)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    ###### get stems ######
+
+    print('Loading files...')
+
+    tasks = song_tasks(input_dir, do_ambience, do_stomps, output_dir, seed)
+
+    print('Done')
+
+    if incremental:
+        # only the songs whose stems or settings changed since they were mixed
+        done = [task for task in tasks if deps.up_to_date(*mix_inputs(task))]
+        for task in done:
+            print(f'{task[0]} is up to date')
+        tasks = [task for task in tasks if task not in done]
+
+    ###### songs ######
+    print('Processing...')
+
+    if workers > 1:
+        # every worker builds the reverbs it uses
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(mix_song, *task): task for task in tasks}
+            for future in as_completed(futures):
+                future.result()
+                if incremental:
+                    deps.record(*mix_inputs(futures[future]))
+                print(f'{futures[future][0]} done')
+    else:
+        # go through each song
+        for task in tasks:
+            print(task[0])
+            mix_song(*task)
+            if incremental:
+                deps.record(*mix_inputs(task))
 
     print('Done')
 
@@ -182,5 +321,7 @@ if __name__ == '__main__':
     parser.add_argument('-a', action='store_true')
     parser.add_argument('-s', action='store_true')
     parser.add_argument('output')
+    parser.add_argument('--workers', type=int, default=1, help='songs mixed in parallel')
+    parser.add_argument('--seed', type=int, default=None, help='seed for the reverb and ambience choices')
     args = parser.parse_args()
-    main(args.input, args.a, args.s, args.output)
+    main(args.input, args.a, args.s, args.output, args.workers, args.seed)
@@ -2,11 +2,24 @@ import numpy as np
 import pretty_midi
 from revoice import pack_voices, unpack_voices
 import os
-
-import cProfile
+import metrics
 
 pretty_midi.pretty_midi.MAX_TICK = 1e10
 
+# clip lengths (s) the renderer is configured for,
+# longer tunes are rounded up to a multiple of the step
+CLIP_BUCKETS = [16, 30, 60, 120, 150]
+CLIP_BUCKET_STEP = 30
+
+def clip_bucket(duration):
+    for b in CLIP_BUCKETS:
+        if duration <= b:
+            return b
+    return int(np.ceil(duration/CLIP_BUCKET_STEP))*CLIP_BUCKET_STEP
+
+def clip_duration_of(batch, midi_frame_rate=250):
+    return batch["midi_pitch"].shape[1] // midi_frame_rate
+
 
 def load_midi_examples(midi_dir, midi_frame_rate, clip_duration, voice_limit, sample_rate):
     out_dict = {}
@@ -16,37 +29,18 @@ def load_midi_examples(midi_dir, midi_frame_rate, clip_duration, voice_limit, sa
     return out_dict
 
 
+@metrics.measured('load_midi', tune_arg=0)
 def load_midi(midi_path, midi_frame_rate=250, clip_duration=4, n_voices=32, sampling_rate=16000):
 
-    clip_frames = clip_duration*midi_frame_rate
-
     midi = pretty_midi.PrettyMIDI(midi_path)
 
-    clip_f0 = np.zeros(clip_frames)
-    clip_ld = np.zeros(clip_frames)
-
-    last_end_index = 0
-    prev_note = midi.instruments[0].notes[0]
-    for note in midi.instruments[0].notes:
-
-        # calculate start and end frames
-        start_index = int(round(note.start*midi_frame_rate))
-        end_index = int(round(note.end*midi_frame_rate))
+    # size the clip to the tune when no duration is given
+    if clip_duration is None:
+        clip_duration = clip_bucket(midi.get_end_time())
 
-        clip_f0[last_end_index : start_index] = prev_note.pitch
-        clip_f0[start_index : end_index] = note.pitch
-        clip_ld[start_index : end_index] = note.velocity
-
-        prev_note = note
-        last_end_index = end_index
-
-    clip_f0[last_end_index : ] = prev_note.pitch
-
-    # push voice dim into batch dim
-    clip_ld = np.array([[[x] for x in clip_ld]], dtype=object)
-    clip_f0 = np.array([[[x] for x in clip_f0]], dtype=object)
+    clip_frames = clip_duration*midi_frame_rate
 
-    return {"midi_pitch": clip_f0.astype("float32"), "midi_velocity": clip_ld.astype("float32")}
+    return rasterize_notes(*note_arrays(midi), clip_frames, midi_frame_rate)
 
     '''
     piano_roll = midi.get_piano_roll(midi_frame_rate)
@@ -79,6 +73,61 @@ def load_midi(midi_path, midi_frame_rate=250, clip_duration=4, n_voices=32, samp
     return {"midi_pitch": clip_f0.astype("float32"), "midi_velocity": clip_ld.astype("float32")}
     '''
 
+@metrics.measured('load_midi', tune_arg=0)
+def load_notes(name, notes, midi_frame_rate=250, clip_duration=None):
+    """As load_midi, for the note arrays of the file `name` already in memory (see note_arrays)."""
+    if clip_duration is None:
+        clip_duration = clip_bucket(float(np.max(notes[3], initial=0.0)))
+
+    return rasterize_notes(*notes, clip_duration*midi_frame_rate, midi_frame_rate)
+
+
+def note_arrays(midi):
+    """Pitch, velocity, start and end arrays of all the notes in a file, ordered by onset."""
+    notes = [n for instr in midi.instruments if not instr.is_drum for n in instr.notes]
+
+    pitch = np.fromiter((n.pitch for n in notes), dtype=np.float32, count=len(notes))
+    velocity = np.fromiter((n.velocity for n in notes), dtype=np.float32, count=len(notes))
+    start = np.fromiter((n.start for n in notes), dtype=np.float64, count=len(notes))
+    end = np.fromiter((n.end for n in notes), dtype=np.float64, count=len(notes))
+
+    order = np.argsort(start, kind='stable')
+    return pitch[order], velocity[order], start[order], end[order]
+
+
+def rasterize_notes(pitch, velocity, start, end, clip_frames, midi_frame_rate=250):
+    """
+    Frame-rate pitch and velocity curves of a monophonic note sequence, shaped [1, clip_frames, 1].
+
+    Each frame takes the pitch of the latest onset before it (the first pitch before the first onset),
+    so gaps between notes hold the previous pitch, and the velocity of that note while it sounds.
+    """
+    clip_f0 = np.zeros((1, clip_frames, 1), dtype=np.float32)
+    clip_ld = np.zeros((1, clip_frames, 1), dtype=np.float32)
+
+    if len(pitch) == 0:
+        return {"midi_pitch": clip_f0, "midi_velocity": clip_ld}
+
+    # calculate start and end frames
+    start_index = np.minimum(np.round(start*midi_frame_rate).astype(np.int64), clip_frames)
+    end_index = np.round(end*midi_frame_rate).astype(np.int64)
+
+    # index of the sounding note at each frame: mark onsets, then carry them forward
+    owner = np.zeros(clip_frames + 1, dtype=np.int64)
+    np.maximum.at(owner, start_index, np.arange(len(pitch)))
+    owner = np.maximum.accumulate(owner[:clip_frames])
+
+    np.take(pitch, owner, out=clip_f0[0, :, 0])
+
+    # velocity only while the note is held
+    frames = np.arange(clip_frames)
+    sounding = (frames >= start_index[owner]) & (frames < end_index[owner])
+    np.take(velocity, owner, out=clip_ld[0, :, 0])
+    clip_ld[0, ~sounding, 0] = 0
+
+    return {"midi_pitch": clip_f0, "midi_velocity": clip_ld}
+
+
 def remove_0_pitch(pitch_vector):
     for v in range(pitch_vector.shape[0]):
         t = 0
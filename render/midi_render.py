@@ -1,163 +1,364 @@
 import ddsp
+import numpy as np
+import tensorflow.compat.v2 as tf
 import time
 import os
+import sys
+
+# the pipeline modules (metrics, deps) live in the parent folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import deps
+
 from control_models import *
 from trn_lib import *
 from synthesis_models import *
 from load_midi import *
+from model_registry import ModelRegistry
+from render_cache import RenderCache, RENDER_CACHE_DIR, midi_hash
+import render_queue
 import random
 import argparse
 
-###### args ######
-parser = argparse.ArgumentParser(description='')
-'''
-parser.add_argument('naive')
-parser.add_argument('loudness')
-parser.add_argument('-v', action='store_true')
-parser.add_argument('-p', action='store_true')
-'''
-parser.add_argument('tunes')
-parser.add_argument('output')
-args = parser.parse_args()
-
-tunes_dir = args.tunes
-output_dir = args.output
-
-naive_perc = 0.25   #float(args.naive)
-loudness_perc = 1   #float(args.loudness)
-vibrato_on = False  #args.v
-do_plots = False    #args.p
-plot_path = f'{output_dir}/plots/'
-
 
 ###### directories ######
-ALL_MODELS_DIR = './models'
-
-# create non existent dirs
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
-
-if not os.path.exists(plot_path) and do_plots:
-    os.makedirs(plot_path)
-
-# get all instruments to render
-instruments = os.listdir(tunes_dir)
-
-for i in instruments:
-    d = f'{output_dir}/{i}'
-    if not os.path.exists(d):
-        os.makedirs(d)
+ALL_MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
 
 ###### models ######
 
 # model parameters
-CLIP_DURATION = 150
 SAMPLE_RATE = 16000
 FEATURE_FRAME_RATE = 250
 
-# load all models
+# length of the reverb of the synthesis models (Reverb.reverb_length in the gin configs, samples)
+REVERB_LENGTH = 48000
 
-print('Loading models...')
+# streaming synthesis window, warm-up and cross-fade (s),
+# the warm-up holds the whole reverb tail of the audio before the window
+STREAM_WINDOW = 16
+STREAM_WARMUP = REVERB_LENGTH/SAMPLE_RATE
+STREAM_OVERLAP = 0.5
 
-# dictionaries containing a list of the model variants for each entry
-synthesis_models = {}
-control_models = {}
-
-for i in instruments:
-    synthesis_models[i] = []
-    control_models[i] = []
-
-for i in instruments:
-    print(i)
-
-    model_dir = f'{ALL_MODELS_DIR}/{i}'
-    synth_dir = f'{model_dir}/synthesis'
-    contr_dir = f'{model_dir}/control'
-
-    variants = os.listdir(synth_dir)
-    for v in variants:
-        st = time.time()
-
-        synthesis_models[i].append(
-            get_trained_synthesis_model(f'{synth_dir}/{v}', CLIP_DURATION=CLIP_DURATION))
+NAIVE_PERC = {
+    'accordion': 1,
+    'fiddle': 0.25,
+    'whistle': 0.1
+}
 
-        et = time.time() - st
-        print(f'\t{i}/{v} synth took {et} s')
 
-    variants = os.listdir(contr_dir)
-    for v in variants:
-        st = time.time()
+def set_threads(threads):
+    # one pool of intra-op threads for the big matmuls, few inter-op threads
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(2)
+    except RuntimeError:
+        print('TensorFlow already initialized, keeping its thread settings')
+
+
+class Renderer:
+    """
+    Control-synthesis renderer that keeps its models loaded between calls.
+
+    Model variants are restored the first time a tune is assigned to them (see ModelRegistry)
+    and reused by every following `render` / `render_dir` call.
+    """
+
+    def __init__(self, models_dir=ALL_MODELS_DIR, batch_size=0, stream=False, max_models=8,
+                 loudness_perc=1, vibrato_on=False, do_plots=False, plot_path=None, cache=None):
+        self.models = ModelRegistry(models_dir, max_models=max_models, FEATURE_FRAME_RATE=FEATURE_FRAME_RATE)
+        self.batch_size = batch_size
+        self.stream = stream
+
+        # a RenderCache to reuse earlier renders of the same midi
+        self.cache = cache
+
+        self.naive_perc = NAIVE_PERC
+        self.loudness_perc = loudness_perc
+        self.vibrato_on = vibrato_on
+        self.do_plots = do_plots
+        self.plot_path = plot_path
+
+    def synthesis_clip(self, CLIP_DURATION):
+        # when streaming the synthesis models only need the window length
+        return STREAM_WINDOW if self.stream else CLIP_DURATION
+
+    def get_batch_size(self, CLIP_DURATION):
+        if self.batch_size > 0:
+            return self.batch_size
+        return auto_batch_size(self.synthesis_clip(CLIP_DURATION)*SAMPLE_RATE)
+
+    def choose_variants(self, instrument, batch_hash=None):
+        """
+        Random (control, synthesis) variant names for a tune.
+        With a cache the choice follows from the midi content, so a re-run picks the cached render.
+        """
+        rng = random if batch_hash is None or self.cache is None else random.Random(batch_hash)
+        return (rng.choice(self.models.variants(instrument, 'control')),
+                rng.choice(self.models.variants(instrument, 'synthesis')))
+
+    def cache_key(self, instrument, CLIP_DURATION, variants, batch_hash):
+        control_variant, synthesis_variant = variants
+        checkpoints = [self.models.checkpoint('control', instrument, control_variant),
+                       self.models.checkpoint('synthesis', instrument, synthesis_variant)]
+        params = dict(self.stem_params(instrument), clip=CLIP_DURATION)
+        return self.cache.key(batch_hash, checkpoints, params)
+
+    def get_models(self, instrument, CLIP_DURATION, variants):
+        control_variant, synthesis_variant = variants
+        return (self.models.control(instrument, control_variant, CLIP_DURATION),
+                self.models.synthesis(instrument, synthesis_variant, self.synthesis_clip(CLIP_DURATION)))
+
+    def load(self, midi_path):
+        # each clip is sized to its tune, rounded up to a length bucket
+        return load_midi(midi_path, midi_frame_rate=FEATURE_FRAME_RATE,
+                         clip_duration=None, n_voices=1, sampling_rate=SAMPLE_RATE)
+
+    def load_notes(self, name, notes):
+        return load_notes(name, notes, midi_frame_rate=FEATURE_FRAME_RATE)
+
+    def render(self, midi_path, instrument=None):
+        """Render one midi file and return its audio. The instrument defaults to the name of the parent folder."""
+
+        if instrument is None:
+            instrument = os.path.basename(os.path.dirname(os.path.abspath(midi_path)))
+
+        demo_batch = self.load(midi_path)
+        CLIP_DURATION = clip_duration_of(demo_batch, FEATURE_FRAME_RATE)
+        control_variant, synthesis_variant = self.choose_variants(instrument)
+        # the audio is returned whole, so even when streaming the synthesis model covers the whole clip
+        control_model = self.models.control(instrument, control_variant, CLIP_DURATION)
+        synthesis_model = self.models.synthesis(instrument, synthesis_variant, CLIP_DURATION)
+
+        generated_audio = generate_audio(control_model, synthesis_model,
+                                         os.path.basename(midi_path) + '.png', self.do_plots, self.plot_path,
+                                         demo_batch, self.naive_perc[instrument], self.loudness_perc, self.vibrato_on)
+
+        return np.nan_to_num(tf.squeeze(generated_audio['generated_performance'][0, ...]).numpy())
+
+    def stem_params(self, instrument):
+        return {
+            'stream': self.stream,
+            'naive_perc': self.naive_perc[instrument],
+            'loudness_perc': self.loudness_perc,
+            'vibrato_on': self.vibrato_on
+        }
+
+    def render_dir(self, tunes_dir, output_dir, incremental=False, files=None, notes=None):
+        """
+        Render every `<tunes_dir>/<instrument>/*.mid` to `<output_dir>/<instrument>/`.
+        With `incremental`, the midi files whose stem is up to date (see deps) are skipped.
+        `files` restricts the rendering to a list of `<instrument>/<midi name>`.
+        `notes` maps some of them to their note arrays (see note_arrays), used instead of reading the file.
+        """
+        notes = notes or {}
+
+        # create non existent dirs
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        if self.do_plots and not os.path.exists(self.plot_path):
+            os.makedirs(self.plot_path)
+
+        # get all instruments to render
+        instruments = os.listdir(tunes_dir)
+
+        for i in instruments:
+            d = f'{output_dir}/{i}'
+            if not os.path.exists(d):
+                os.makedirs(d)
+
+        ###### midi ######
+
+        print('Loading midi files...')
+
+        all_midi = {}
+
+        # get files to render
+        # for each instrument
+        for ins in instruments:
+            names = deps.listdir(f'{tunes_dir}/{ins}')
+            if files is not None:
+                names = [fn for fn in names if f'{ins}/{fn}' in files]
+            if incremental:
+                names = [fn for fn in names
+                         if not deps.up_to_date(f'{output_dir}/{ins}/{fn}_generated_performance.wav',
+                                                [f'{tunes_dir}/{ins}/{fn}'], self.stem_params(ins))]
+
+            midi_num = len(names)
+            print(f'{ins}: {midi_num} files')
+            st = time.time()
+
+            all_midi[ins] = {fn: self.load_notes(f'{ins}/{fn}', notes[f'{ins}/{fn}']) if f'{ins}/{fn}' in notes
+                             else self.load(f'{tunes_dir}/{ins}/{fn}') for fn in names}
+
+            et = time.time() - st
+            print(f'\t{ins} files took {et} s')
+            if midi_num != 0:
+                print(f'\t{et/midi_num} s per file')
 
-        c_m = AimuControlModel(n_timesteps=CLIP_DURATION*FEATURE_FRAME_RATE)
-        restore(c_m, None, 0, f'{contr_dir}/{v}')
-        control_models[i].append(c_m)
+            print('done')
+
+        print('Done')
 
-        et = time.time() - st
-        print(f'\t{i}/{v} control took {et} s')
+        ###### rendering ######
 
-    print('done')
+        print('Rendering midi files...')
 
-print('Done')
-print('Loading midi files...')
+        for ins in instruments:
 
-all_midi = {}
+            print(ins)
 
-# get files to render
-# for each instrument
-for ins in instruments:
-    midi_num = len(os.listdir(f'{tunes_dir}/{ins}'))
-    print(f'{ins}: {midi_num} files')
-    st = time.time()
+            midi_files = all_midi[ins]
+            writer = StemWriter(f'{output_dir}/{ins}', SAMPLE_RATE)
 
-    all_midi[ins] = load_midi_examples(midi_dir=f"{tunes_dir}/{ins}",midi_frame_rate=FEATURE_FRAME_RATE,
-                                       clip_duration=CLIP_DURATION, voice_limit=1, sample_rate=SAMPLE_RATE)
+            # assign a random model variant to each tune
+            # and group the tunes sharing the same variants and clip length
+            groups = {}
+            cache_keys = {}
+            for midi_name, demo_batch in midi_files.items():
+                CLIP_DURATION = clip_duration_of(demo_batch, FEATURE_FRAME_RATE)
+                batch_hash = midi_hash(demo_batch) if self.cache is not None else None
+                variants = self.choose_variants(ins, batch_hash)
 
-    et = time.time() - st
-    print(f'\t{ins} files took {et} s')
-    if midi_num != 0:
-        print(f'\t{et/midi_num} s per file')
+                if self.cache is not None:
+                    key = self.cache_key(ins, CLIP_DURATION, variants, batch_hash)
+                    path = writer.path(f'{midi_name}_generated_performance')
+                    if self.cache.get(key, path):
+                        writer.add(os.path.getsize(path), 0)
+                        deps.record(path, [f'{tunes_dir}/{ins}/{midi_name}'], self.stem_params(ins))
+                        print(f'{midi_name}: reusing cached render')
+                        continue
+                    cache_keys[midi_name] = key
 
-    print('done')
+                groups.setdefault((CLIP_DURATION, variants), []).append(midi_name)
 
-print('Done')
+            # only the assigned variants get restored, one group after the other
+            for (CLIP_DURATION, variants), names in sorted(groups.items()):
+                batch_size = self.get_batch_size(CLIP_DURATION)
+                print(f'{CLIP_DURATION}s clips, variants {variants}, batch size {batch_size}')
 
-###### rendering ######
+                control_model, synthesis_model = self.get_models(ins, CLIP_DURATION, variants)
 
-print('Rendering midi files...')
+                for b in range(0, len(names), batch_size):
 
-naive_perc = {
-    'accordion': 1,
-    'fiddle': 0.25,
-    'whistle': 0.1
-}
+                    batch_names = names[b : b+batch_size]
+                    print(', '.join(batch_names))
+                    self.render_batch(ins, control_model, synthesis_model,
+                                      batch_names, [midi_files[n] for n in batch_names], writer)
 
-for ins in instruments:
+                    for n in batch_names:
+                        path = writer.path(f'{n}_generated_performance')
+                        deps.record(path, [f'{tunes_dir}/{ins}/{n}'], self.stem_params(ins))
+                        if n in cache_keys:
+                            self.cache.put(cache_keys[n], path)
 
-    print(ins)
+                del control_model, synthesis_model
 
-    midi_files = all_midi[ins]
-    midi_audio_dict = {}
+            print(f'\t{writer.stems} stems, {writer.bytes_written} bytes written in {writer.seconds} s')
+            if self.cache is not None:
+                print(f'\tcache: {self.cache.hits} hits, {self.cache.misses} misses')
+            print('done')
 
-    for midi_name, demo_batch in midi_files.items():
+        print('Done')
 
-        print(midi_name)
+    def render_batch(self, ins, control_model, synthesis_model, batch_names, demo_batches, writer):
         st = time.time()
-        generated_audio = generate_audio(random.choice(control_models[ins]), random.choice(synthesis_models[ins]),
-                                         midi_name + '.png', do_plots, plot_path, demo_batch,
-                                         naive_perc[ins], loudness_perc, vibrato_on)
-        et = time.time() - st
-        print(f'\tPerformance generation took {et} s')
 
-        for k in generated_audio.keys():
-            midi_audio_dict[f'{midi_name}_{k}'] = generated_audio[k]
-
-        st = time.time()
-        save_audio_from_dict(midi_audio_dict, f'{output_dir}/{ins}', SAMPLE_RATE)
+        if self.stream:
+            # the stems are written window by window while synthesizing
+            demo_batch = {k: np.concatenate([d[k] for d in demo_batches], axis=0) for k in demo_batches[0]}
+            paths = [writer.path(f'{n}_generated_performance') for n in batch_names]
+            sizes = generate_performance_streaming(control_model, synthesis_model,
+                                                   [n + '.png' for n in batch_names], self.do_plots, self.plot_path, demo_batch,
+                                                   self.naive_perc[ins], self.loudness_perc, self.vibrato_on,
+                                                   paths, SAMPLE_RATE,
+                                                   STREAM_WINDOW*FEATURE_FRAME_RATE,
+                                                   int(STREAM_WARMUP*FEATURE_FRAME_RATE),
+                                                   int(STREAM_OVERLAP*FEATURE_FRAME_RATE), FEATURE_FRAME_RATE)
+            et = time.time() - st
+            for n_bytes in sizes:
+                writer.add(n_bytes, 0)
+            print(f'\tStreaming generation took {et} s ({et/len(batch_names)} s per tune, {sum(sizes)} bytes)')
+            return
+
+        generated_audio = generate_audio_batch(control_model, synthesis_model,
+                                               [n + '.png' for n in batch_names], self.do_plots, self.plot_path,
+                                               demo_batches,
+                                               self.naive_perc[ins], self.loudness_perc, self.vibrato_on)
         et = time.time() - st
-        print(f'\tSaving took {et} s')
-
-    print('done')
-
-print('Done')
-
-
+        print(f'\tPerformance generation took {et} s ({et/len(batch_names)} s per tune)')
+
+        # write each stem once and drop it right away
+        for midi_name, audio in zip(batch_names, generated_audio):
+            for k in list(audio.keys()):
+                n_bytes, et = writer.write(f'{midi_name}_{k}', audio.pop(k))
+                print(f'\tSaving {midi_name} {k} took {et} s ({n_bytes} bytes)')
+
+        del generated_audio
+
+    def serve(self, queue_dir, poll=1.0):
+        """Render the jobs submitted to `queue_dir` (see render_queue) forever, keeping the models warm."""
+
+        print(f'Waiting for jobs in {queue_dir}')
+        while True:
+            job = render_queue.claim(queue_dir)
+            if job is None:
+                time.sleep(poll)
+                continue
+
+            job_id, params = job
+            print(f'Job {job_id}: {params["tunes"]} -> {params["output"]}')
+            st = time.time()
+            try:
+                self.render_dir(params['tunes'], params['output'],
+                                params.get('incremental', False), params.get('files'))
+            except Exception as e:
+                render_queue.finish(queue_dir, job_id, error=repr(e))
+                print(f'Job {job_id} failed: {e!r}')
+            else:
+                render_queue.finish(queue_dir, job_id)
+                print(f'Job {job_id} took {time.time() - st} s')
+
+
+if __name__ == '__main__':
+    ###### args ######
+    parser = argparse.ArgumentParser(description='Render midi files with the control-synthesis models')
+    '''
+    parser.add_argument('naive')
+    parser.add_argument('loudness')
+    parser.add_argument('-v', action='store_true')
+    parser.add_argument('-p', action='store_true')
+    '''
+    parser.add_argument('tunes', nargs='?')
+    parser.add_argument('output', nargs='?')
+    parser.add_argument('--batch-size', type=int, default=0, help='tunes rendered together (0 = fit to available memory)')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help='BLAS/intra-op threads')
+    parser.add_argument('--stream', action='store_true', help='synthesize in fixed windows to bound memory use')
+    parser.add_argument('--max-models', type=int, default=8, help='restored models kept in memory')
+    parser.add_argument('--incremental', action='store_true', help='skip the midi files whose stem is up to date')
+    parser.add_argument('--reuse', action='store_true', help='reuse cached renders of identical midi, models and settings')
+    parser.add_argument('--cache-dir', default=None, help='render cache folder (default $FOLKRNN_RENDER_CACHE or ./.render_cache)')
+    parser.add_argument('--cache-size', type=float, default=20, help='render cache size limit in GB')
+    parser.add_argument('--serve', metavar='QUEUE_DIR', help='keep the models loaded and render the jobs queued in this folder')
+    args = parser.parse_args()
+
+    if args.serve is None and (args.tunes is None or args.output is None):
+        parser.error('tunes and output are required unless --serve is given')
+
+    set_threads(args.threads)
+
+    loudness_perc = 1   #float(args.loudness)
+    vibrato_on = False  #args.v
+    do_plots = False    #args.p
+
+    cache = None
+    if args.reuse:
+        cache = RenderCache(args.cache_dir or RENDER_CACHE_DIR, max_bytes=int(args.cache_size*1024**3))
+
+    renderer = Renderer(batch_size=args.batch_size, stream=args.stream, max_models=args.max_models,
+                        loudness_perc=loudness_perc, vibrato_on=vibrato_on, do_plots=do_plots,
+                        plot_path=f'{args.output}/plots/', cache=cache)
+
+    if args.serve is not None:
+        renderer.serve(args.serve)
+    else:
+        renderer.render_dir(args.tunes, args.output, args.incremental)
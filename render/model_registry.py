@@ -0,0 +1,88 @@
+import os
+import gc
+import time
+from collections import OrderedDict
+import ddsp.training
+from control_models import AimuControlModel
+from synthesis_models import get_trained_synthesis_model
+from trn_lib import restore, available_memory
+
+
+class ModelRegistry:
+    """
+    Restores model variants only when a tune needs them.
+
+    At most `max_models` restored models stay resident, the least recently used one is dropped first,
+    earlier if free memory falls below `min_free_memory` bytes.
+    """
+
+    def __init__(self, models_dir, max_models=8, min_free_memory=2*1024**3, FEATURE_FRAME_RATE=250):
+        self.models_dir = models_dir
+        self.max_models = max(2, max_models)
+        self.min_free_memory = min_free_memory
+        self.feature_frame_rate = FEATURE_FRAME_RATE
+
+        # (kind, instrument, variant, clip length) -> model
+        self.models = OrderedDict()
+
+    def variants(self, instrument, kind):
+        """Names of the checkpoints available for an instrument ('control' or 'synthesis'), without loading them."""
+        return sorted(os.listdir(f'{self.models_dir}/{instrument}/{kind}'))
+
+    def checkpoint(self, kind, instrument, variant):
+        """Identifier of the checkpoint a variant restores from, changes when the checkpoint is retrained."""
+        path = f'{self.models_dir}/{instrument}/{kind}/{variant}'
+        latest = ddsp.training.train_util.get_latest_chekpoint(path)
+        if latest is None:
+            return f'{instrument}/{kind}/{variant}'
+
+        index = f'{latest}.index'
+        mtime = os.path.getmtime(index) if os.path.exists(index) else 0
+        return f'{instrument}/{kind}/{variant}/{os.path.basename(latest)}@{mtime}'
+
+    def control(self, instrument, variant, CLIP_DURATION):
+        return self.get('control', instrument, variant, CLIP_DURATION)
+
+    def synthesis(self, instrument, variant, CLIP_DURATION):
+        return self.get('synthesis', instrument, variant, CLIP_DURATION)
+
+    def get(self, kind, instrument, variant, CLIP_DURATION):
+        key = (kind, instrument, variant, CLIP_DURATION)
+
+        if key in self.models:
+            self.models.move_to_end(key)
+            return self.models[key]
+
+        self.evict()
+
+        st = time.time()
+        path = f'{self.models_dir}/{instrument}/{kind}/{variant}'
+        if kind == 'synthesis':
+            model = get_trained_synthesis_model(path, CLIP_DURATION=CLIP_DURATION)
+        else:
+            model = AimuControlModel(n_timesteps=CLIP_DURATION*self.feature_frame_rate)
+            restore(model, None, 0, path)
+
+        et = time.time() - st
+        print(f'\t{instrument}/{variant} {CLIP_DURATION}s {kind} took {et} s')
+
+        self.models[key] = model
+        return model
+
+    def evict(self):
+        """
+        Make room for one more model. The last model returned is kept: it is in use by the caller
+        (e.g. the control model of the pair being loaded), dropping it would free nothing.
+        """
+        evicted = False
+        while len(self.models) > 1 and (len(self.models) >= self.max_models or self.low_memory()):
+            (kind, instrument, variant, CLIP_DURATION), _ = self.models.popitem(last=False)
+            print(f'\tevicting {instrument}/{variant} {CLIP_DURATION}s {kind}')
+            evicted = True
+
+        if evicted:
+            gc.collect()
+
+    def low_memory(self):
+        memory = available_memory()
+        return memory is not None and memory < self.min_free_memory
@@ -0,0 +1,85 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+
+RENDER_CACHE_DIR = os.environ.get('FOLKRNN_RENDER_CACHE', './.render_cache')
+
+
+def midi_hash(batch):
+    """Content hash of the midi frames fed to the control model."""
+    h = hashlib.sha256()
+    for k in sorted(batch):
+        a = np.ascontiguousarray(batch[k], dtype=np.float32)
+        h.update(k.encode())
+        h.update(str(a.shape).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+class RenderCache:
+    """
+    Content-addressed store of rendered stems.
+
+    An entry is keyed by the midi content, the model checkpoints and the render parameters,
+    so a performance is synthesized once and copied out on every later request.
+    The least recently used entries are removed once the cache grows past `max_bytes`.
+    """
+
+    def __init__(self, cache_dir=RENDER_CACHE_DIR, max_bytes=20*1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, batch_hash, checkpoints, params):
+        h = hashlib.sha256()
+        h.update(batch_hash.encode())
+        h.update(json.dumps([checkpoints, params], sort_keys=True).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return f'{self.cache_dir}/{key[:2]}/{key}.wav'
+
+    def get(self, key, output_path):
+        """Copy a cached stem to `output_path`, returns False if it is not cached."""
+        path = self.path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return False
+
+        # mark as recently used
+        os.utime(path)
+        shutil.copyfile(path, output_path)
+        self.hits += 1
+        return True
+
+    def put(self, key, stem_path):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp = f'{path}.{os.getpid()}.tmp'
+        shutil.copyfile(stem_path, tmp)
+        os.replace(tmp, path)
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for d in os.listdir(self.cache_dir):
+            folder = f'{self.cache_dir}/{d}'
+            if os.path.isdir(folder):
+                for f in os.listdir(folder):
+                    if f.endswith('.wav'):
+                        st = os.stat(f'{folder}/{f}')
+                        entries.append((st.st_mtime, st.st_size, f'{folder}/{f}'))
+
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import uuid
+import socket
+
+# A folder-based job queue for a long-running renderer (midi_render.py --serve).
+# Jobs are json files moving through <id>.job -> <id>.running -> <id>.done,
+# renames are atomic so several workers can share a queue.
+# A running job names the worker that claimed it, so a job left by a worker that died is queued again.
+
+
+def submit(queue_dir, tunes, output, incremental=False, files=None):
+    """Queue the rendering of `tunes` (only `files` if given) into `output`, returns the job id."""
+    os.makedirs(queue_dir, exist_ok=True)
+
+    job_id = f'{time.time_ns()}_{uuid.uuid4().hex[:8]}'
+    tmp = f'{queue_dir}/{job_id}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'tunes': os.path.abspath(tunes), 'output': os.path.abspath(output),
+                   'incremental': incremental, 'files': files}, f)
+    os.rename(tmp, f'{queue_dir}/{job_id}.job')
+
+    return job_id
+
+
+def claim(queue_dir):
+    """Take the oldest queued job, returns (job id, params) or None if the queue is empty."""
+    os.makedirs(queue_dir, exist_ok=True)
+
+    for job in sorted(f for f in os.listdir(queue_dir) if f.endswith('.job')):
+        job_id = job[:-len('.job')]
+        running = f'{queue_dir}/{job_id}.running'
+        try:
+            os.rename(f'{queue_dir}/{job}', running)
+        except FileNotFoundError:
+            # taken by another worker
+            continue
+
+        with open(running) as f:
+            params = json.load(f)
+        write_job(running, {**params, 'worker': {'host': socket.gethostname(), 'pid': os.getpid()}})
+        return job_id, params
+
+    return None
+
+
+def write_job(path, params):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(params, f)
+    os.replace(tmp, path)
+
+
+def worker_alive(worker):
+    # only a worker of this machine can be checked
+    if worker['host'] != socket.gethostname():
+        return True
+    try:
+        os.kill(worker['pid'], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def finish(queue_dir, job_id, error=None):
+    tmp = f'{queue_dir}/{job_id}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'error': error}, f)
+    os.rename(tmp, f'{queue_dir}/{job_id}.done')
+    os.remove(f'{queue_dir}/{job_id}.running')
+
+
+def wait(queue_dir, job_id, poll=1.0, timeout=None, retries=1):
+    """
+    Block until a job is done, raises RuntimeError if it failed. A job whose worker died is queued
+    again up to `retries` times, then fails. Raises TimeoutError after `timeout` seconds if given.
+    """
+    done = f'{queue_dir}/{job_id}.done'
+    running = f'{queue_dir}/{job_id}.running'
+    st = time.time()
+    while not os.path.exists(done):
+        try:
+            with open(running) as f:
+                params = json.load(f)
+        except FileNotFoundError:
+            # queued, being claimed or just finished
+            params = {}
+
+        worker = params.get('worker')
+        if worker is not None and not worker_alive(worker) and not os.path.exists(done):
+            attempts = params.get('attempts', 0) + 1
+            if attempts > retries:
+                os.remove(running)
+                raise RuntimeError(f'Render job {job_id} failed: worker {worker["pid"]} on {worker["host"]} died')
+
+            print(f'Worker {worker["pid"]} died, render job {job_id} queued again')
+            del params['worker']
+            write_job(running, {**params, 'attempts': attempts})
+            os.rename(running, f'{queue_dir}/{job_id}.job')
+
+        if timeout is not None and time.time() - st > timeout:
+            raise TimeoutError(f'Render job {job_id} not done after {timeout} s')
+        time.sleep(poll)
+
+    with open(done) as f:
+        result = json.load(f)
+    os.remove(done)
+
+    if result['error'] is not None:
+        raise RuntimeError(f'Render job {job_id} failed: {result["error"]}')
@@ -1,11 +1,45 @@
 import os
+import re
+import hashlib
 import ddsp.training
 import gin
 
+GIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gin')
+GIN_TEMPLATE = '150s.gin'
+# configs generated for the clip lengths without one in GIN_DIR
+GIN_CACHE_DIR = os.environ.get('FOLKRNN_GIN_CACHE', './.gin_cache')
+
+def get_clip_gin(CLIP_DURATION, SAMPLE_RATE=16000, FEATURE_FRAME_RATE=250):
+    """Path of the gin config for a clip length, generated from the template if missing."""
+
+    gin_file = f'{GIN_DIR}/{CLIP_DURATION}s.gin'
+    if os.path.exists(gin_file):
+        return gin_file
+
+    with open(f'{GIN_DIR}/{GIN_TEMPLATE}') as f:
+        config = f.read()
+
+    n_samples = CLIP_DURATION*SAMPLE_RATE
+    time_steps = CLIP_DURATION*FEATURE_FRAME_RATE
+    config = re.sub(r'(\w+\.n_samples = )\d+', rf'\g<1>{n_samples}', config)
+    config = re.sub(r'(\w+\.time_steps = )\d+', rf'\g<1>{time_steps}', config)
+
+    # named by content, so a changed template gives a new file
+    gin_file = f'{GIN_CACHE_DIR}/{CLIP_DURATION}s_{hashlib.sha1(config.encode()).hexdigest()[:16]}.gin'
+    if not os.path.exists(gin_file):
+        # written whole then renamed, other renderers may be reading it
+        os.makedirs(GIN_CACHE_DIR, exist_ok=True)
+        tmp = f'{gin_file}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(config)
+        os.replace(tmp, gin_file)
+
+    return gin_file
+
 def get_trained_synthesis_model(restore_path, CLIP_DURATION=4):
 
     if CLIP_DURATION != 4:
-        gin_file = f"./gin/{CLIP_DURATION}s.gin"
+        gin_file = get_clip_gin(CLIP_DURATION)
     else:
         # Parse the gin config.
         gin_file = os.path.join(restore_path,
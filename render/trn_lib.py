@@ -4,12 +4,50 @@ import numpy as np
 import tensorflow.compat.v2 as tf
 from absl import logging
 import time
+import os
 import librosa
+import soundfile as sf
+import weakref
+import metrics
+
+@metrics.measured('save_audio', tune_arg=1)
+def save_audio(audio, path: str, SAMPLE_RATE: int):
+    librosa.output.write_wav(
+        path, np.nan_to_num(tf.squeeze(audio[0, ...]).numpy()), SAMPLE_RATE, norm=False)
+    return os.path.getsize(path)
 
 def save_audio_from_dict(audio_dict: dict, save_path: str, SAMPLE_RATE: int):
     for key, value in audio_dict.items():
-        librosa.output.write_wav(
-            save_path+"/"+key+".wav", np.nan_to_num(tf.squeeze(value[0, ...]).numpy()), SAMPLE_RATE, norm=False)
+        save_audio(value, save_path+"/"+key+".wav", SAMPLE_RATE)
+
+
+class StemWriter:
+    """Write each rendered stem to disk once, as soon as it is generated."""
+
+    def __init__(self, save_path: str, SAMPLE_RATE: int):
+        self.save_path = save_path
+        self.sample_rate = SAMPLE_RATE
+        self.stems = 0
+        self.bytes_written = 0
+        self.seconds = 0.0
+
+    def path(self, key: str):
+        return f'{self.save_path}/{key}.wav'
+
+    def write(self, key: str, audio):
+        st = time.time()
+        n_bytes = save_audio(audio, self.path(key), self.sample_rate)
+        et = time.time() - st
+
+        self.add(n_bytes, et)
+
+        return n_bytes, et
+
+    def add(self, n_bytes: int, seconds: float):
+        """Account for a stem written elsewhere (e.g. streamed to disk)."""
+        self.stems += 1
+        self.bytes_written += n_bytes
+        self.seconds += seconds
 
 
 def generate_audio(control_model, synthesis_model,
@@ -27,6 +65,77 @@ def generate_audio(control_model, synthesis_model,
 
     return audio
 
+def generate_audio_batch(control_model, synthesis_model,
+                         midi_names, do_plots, plot_export_path, batches,
+                         naive_perc, loudness_perc, vibrato_on):
+    """Render several tunes of the same length in one batch and split the result per tune."""
+
+    # stack the tunes along the batch dimension
+    batch = {k: np.concatenate([b[k] for b in batches], axis=0) for k in batches[0]}
+
+    generated_performance = generate_performance(control_model, synthesis_model,
+                                                 midi_names, do_plots, plot_export_path, batch,
+                                                 naive_perc, loudness_perc, vibrato_on)
+
+    return [{"generated_performance": generated_performance[i:i+1]} for i in range(len(batches))]
+
+def available_memory():
+    """Bytes of memory available to new allocations, as reported by the kernel."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return None
+
+def auto_batch_size(n_samples, max_batch=16, n_harmonics=60, memory_fraction=0.5):
+    """Largest batch whose synthesis buffers fit in a fraction of the available memory."""
+
+    # the additive synth keeps amplitudes and phases for every harmonic at audio rate
+    bytes_per_tune = n_samples*(2*n_harmonics + 16)*4
+
+    memory = available_memory()
+    if memory is None:
+        return 1
+
+    return int(max(1, min(max_batch, memory*memory_fraction // bytes_per_tune)))
+
+# compiled render graphs, per control model, synthesis model and input shape;
+# they are dropped together with the models
+_render_graphs = weakref.WeakKeyDictionary()
+
+def render_graph(control_model, synthesis_model, shape):
+    """
+    The control -> naive blend -> vibrato -> loudness mask -> decode path as a single tf.function,
+    traced once per model pair and input shape [batch, frames, 1].
+    The batch size is part of the signature as the noise synth and the reverb need it statically.
+    """
+    graphs = _render_graphs.setdefault(control_model, weakref.WeakKeyDictionary()).setdefault(synthesis_model, {})
+    shape = tuple(shape)
+
+    if shape not in graphs:
+        frames = tf.TensorSpec(shape, tf.float32)
+        scalar = tf.TensorSpec([], tf.float32)
+
+        # weak references, so the graph does not keep its own cache entry alive
+        control_ref = weakref.ref(control_model)
+        synthesis_ref = weakref.ref(synthesis_model)
+
+        @tf.function(input_signature=[frames, frames, scalar, scalar, scalar, scalar, scalar])
+        def render(midi_pitch, midi_velocity, naive_perc, loudness_perc, vibrato_on, vibrato_level, vibrato_hz):
+            midi_batch = {"midi_pitch": midi_pitch, "midi_velocity": midi_velocity}
+            performance_params = control_ref()(midi_batch, training=False)
+            synth_inputs = control_inputs(performance_params, midi_batch,
+                                          naive_perc, loudness_perc, vibrato_on, vibrato_level, vibrato_hz)
+            return synthesis_ref().decode(synth_inputs)
+
+        graphs[shape] = render
+
+    return graphs[shape]
+
+@metrics.measured('generate_performance', tune_arg=2)
 def generate_performance(
         control_model, synthesis_model,
         midi_name, do_plots, plot_export_path, batch,
@@ -34,114 +143,183 @@ def generate_performance(
         vibrato_on, vibrato_level=0.002, vibrato_hz=5.0,
         resample_ratio=1.0):
 
-    # control model performance
-    performance_params = control_model(batch, training=False)
-    perf_ld_scaled = performance_params["predicted_ld_scaled"]
-    perf_f0_scaled = performance_params["predicted_f0_scaled"]
-    perf_f0_hz = ddsp.core.midi_to_hz(perf_f0_scaled*127.0)
+    if do_plots:
+        # eager, the plots need the intermediate controls
+        synth_inputs = performance_inputs(control_model,
+                                          midi_name, do_plots, plot_export_path, batch,
+                                          naive_perc, loudness_perc,
+                                          vibrato_on, vibrato_level, vibrato_hz,
+                                          resample_ratio)
+        return synthesis_model.decode(synth_inputs)[..., None]
+
+    render = render_graph(control_model, synthesis_model, batch["midi_pitch"].shape)
+    performance_audio = render(tf.convert_to_tensor(batch["midi_pitch"], tf.float32),
+                               tf.convert_to_tensor(batch["midi_velocity"], tf.float32),
+                               tf.constant(naive_perc, tf.float32),
+                               tf.constant(loudness_perc, tf.float32),
+                               tf.constant(float(vibrato_on), tf.float32),
+                               tf.constant(vibrato_level, tf.float32),
+                               tf.constant(vibrato_hz, tf.float32))
+    return performance_audio[..., None]
 
-    if naive_perc != 0:
+@metrics.measured('generate_performance_streaming', tune_arg=2)
+def generate_performance_streaming(
+        control_model, window_model,
+        midi_name, do_plots, plot_export_path, batch,
+        naive_perc, loudness_perc,
+        vibrato_on, output_paths, SAMPLE_RATE,
+        window_frames, warmup_frames=750, overlap_frames=125,
+        FEATURE_FRAME_RATE=250):
+    """
+    Synthesize a performance window by window and write it to `output_paths` (one per batch entry).
+
+    `window_model` is a synthesis model configured for `window_frames` control frames.
+    Each window starts `warmup_frames` early so the decoder RNN and reverb settle,
+    that audio is dropped, and consecutive windows are cross-faded over `overlap_frames`.
+    Peak memory depends on the window length only, not on the tune length.
+    """
+
+    synth_inputs = performance_inputs(control_model,
+                                      midi_name, do_plots, plot_export_path, batch,
+                                      naive_perc, loudness_perc, vibrato_on)
+    synth_inputs = {k: v.numpy() for k, v in synth_inputs.items()}
+
+    n_frames = synth_inputs["f0_hz"].shape[1]
+    frame_samples = SAMPLE_RATE // FEATURE_FRAME_RATE
+    valid_frames = window_frames - warmup_frames
+    hop_frames = valid_frames - overlap_frames
+
+    fade = overlap_frames*frame_samples
+    fade_in = np.linspace(0.0, 1.0, fade, dtype=np.float32)[None, :]
+    fade_out = 1.0 - fade_in
+
+    files = [sf.SoundFile(p, 'w', samplerate=SAMPLE_RATE, channels=1, subtype='FLOAT') for p in output_paths]
+    tail = None
+
+    try:
+        for start in range(0, n_frames, hop_frames):
+
+            # control frames for this window, edge-padded outside the tune
+            first = start - warmup_frames
+            index = np.clip(np.arange(first, first + window_frames), 0, n_frames-1)
+            window = {k: tf.convert_to_tensor(v[:, index]) for k, v in synth_inputs.items()}
+
+            audio = np.nan_to_num(window_model.decode(window).numpy())
+            audio = audio[:, warmup_frames*frame_samples:]
+
+            # cross-fade with the end of the previous window
+            if tail is not None:
+                audio[:, :fade] = audio[:, :fade]*fade_in + tail*fade_out
+
+            last = start + valid_frames >= n_frames
+            if last:
+                out = audio[:, :(n_frames - start)*frame_samples]
+            else:
+                out = audio[:, :hop_frames*frame_samples]
+                tail = audio[:, hop_frames*frame_samples:valid_frames*frame_samples]
 
-        # naive performance
-        naive_params = control_model.preprocess(batch)
-        naive_ld_scaled = naive_params["midi_velocity_scaled"]
-        naive_f0_scaled = naive_params["midi_pitch_scaled"]
-        naive_f0_hz = ddsp.core.midi_to_hz(naive_params["midi_pitch_scaled"]*127.0)
+            for f, a in zip(files, out):
+                f.write(a)
 
-    '''
-    # resampling
-    if resample_ratio < 1.0:
+            if last:
+                break
+    finally:
+        for f in files:
+            f.close()
 
-        ld_scaled = ddsp.core.resample(
-            ld_scaled, int(ld_scaled.shape[1]*resample_ratio))
-        f0_scaled = ddsp.core.resample(
-            f0_scaled, int(f0_scaled.shape[1]*resample_ratio))
-        f0_hz = ddsp.core.resample(
-            f0_hz, int(f0_hz.shape[1]*resample_ratio))
-    '''
+    return [os.path.getsize(p) for p in output_paths]
 
-    ##### pitch #####
+def loudness_mask(midi_pitch, midi_velocity, loudness_perc, PIT_FRAMES=5):
+    """
+    Gain applied to the generated loudness: `loudness_perc` in the 'pits' between notes and 1 elsewhere.
+    A pit starts where the note is silent or changes at the next frame and lasts `PIT_FRAMES` frames.
+    Batched [batch, frames, 1] tensorflow ops, so it runs eagerly or inside a tf.function.
+    """
 
-    if naive_perc != 0:
+    # use midi velocity and midi notes to insert 'pits' in the loudness
+    pits = tf.logical_or(tf.equal(midi_velocity[:, :-1], 0), tf.not_equal(midi_pitch[:, :-1], midi_pitch[:, 1:]))
+    pits = tf.concat([tf.cast(pits, tf.float32), tf.ones_like(midi_pitch[:, :1], tf.float32)], axis=1)
 
-        # interpolate between control and naive
-        f0_scaled = perf_f0_scaled.numpy()
-        f0_orig = f0_scaled.copy()
-        f0_scaled *= 1-naive_perc
-        f0_scaled += naive_perc*naive_f0_scaled
+    # extend the loudness pit to a few frames ahead (a causal max filter)
+    pits = tf.pad(pits, [[0, 0], [PIT_FRAMES-1, 0], [0, 0]])
+    pits = tf.nn.max_pool1d(pits, ksize=PIT_FRAMES, strides=1, padding='VALID')
 
-    # add vibrato
-    if vibrato_on:
-        MIDI_FRAME_RATE = 250.0
-        n_frames = performance_params["predicted_ld_scaled"].shape[1]
-        vibrato_unit = tf.math.sin(
-            tf.linspace(0.0, n_frames/MIDI_FRAME_RATE, n_frames)*vibrato_hz*2.0*3.14)[None, ..., None]
-        vibrato = vibrato_unit*vibrato_level
-        f0_scaled += vibrato
+    return 1.0 - (1.0 - loudness_perc)*pits
 
-    if vibrato_on or naive_perc != 0:
-        f0_scaled = tf.convert_to_tensor(f0_scaled)
+def control_inputs(performance_params, midi_batch, naive_perc, loudness_perc, vibrato_on, vibrato_level, vibrato_hz,
+                   MIDI_FRAME_RATE=250.0):
+    """
+    Synthesis inputs from the control model outputs: pitch blended with the naive (midi) pitch,
+    vibrato when `vibrato_on` is 1 and loudness lowered between the notes of `midi_batch`.
+    Only tensorflow ops, so it runs eagerly or inside a tf.function.
+    """
 
-    else:
-        f0_scaled = perf_f0_scaled
+    ##### pitch #####
+
+    # interpolate between control and naive
+    perf_f0_scaled = performance_params["predicted_f0_scaled"]
+    naive_f0_scaled = performance_params["midi_pitch_scaled"]
+    f0_scaled = perf_f0_scaled*(1.0 - naive_perc) + naive_perc*naive_f0_scaled
+
+    # add vibrato
+    n_frames = tf.shape(f0_scaled)[1]
+    vibrato_unit = tf.math.sin(
+        tf.linspace(0.0, tf.cast(n_frames, tf.float32)/MIDI_FRAME_RATE, n_frames)*vibrato_hz*2.0*3.14)[None, ..., None]
+    f0_scaled += vibrato_on*vibrato_unit*vibrato_level
 
     f0_hz = ddsp.core.midi_to_hz(f0_scaled*127.0)
 
     ##### loudness #####
 
-    if loudness_perc != 1:
+    # update the generated loudness with the midi mask
+    midi_mask = loudness_mask(midi_batch["midi_pitch"], midi_batch["midi_velocity"], loudness_perc)
+    ld_scaled = performance_params["predicted_ld_scaled"]*midi_mask
 
-        midi_notes = np.copy(batch['midi_pitch'])
-        midi_mask = np.copy(batch['midi_pitch'])
+    return {
+        "ld_scaled": ld_scaled,
+        "f0_scaled": f0_scaled,
+        "f0_hz":  f0_hz
+    }
 
-        reduce_perc = loudness_perc
+def performance_inputs(
+        control_model,
+        midi_name, do_plots, plot_export_path, batch,
+        naive_perc, loudness_perc,
+        vibrato_on, vibrato_level=0.002, vibrato_hz=5.0,
+        resample_ratio=1.0):
 
-        # use midi velocity and midi notes to insert 'pits' in the loudness
-        for i in range(len(midi_mask[0])-1):
-            if batch['midi_velocity'][0][i] == 0:
-                midi_mask[0][i] = reduce_perc
-            else:
-                midi_mask[0][i] = 1 if midi_notes[0][i] == midi_notes[0][i+1] else reduce_perc
-        midi_mask[0][-1] = reduce_perc
-
-        # extend the loudness pit to a few frames ahead
-        i = 0
-        while i < len(midi_mask[0]):
-            if midi_mask[0][i] == reduce_perc:
-                j = 0
-                while i < len(midi_mask[0]) and j < 5:
-                    midi_mask[0][i] = reduce_perc
-                    i += 1
-                    j += 1
-            else:
-                i += 1
+    # control model performance
+    performance_params = control_model(batch, training=False)
 
-        # update the generated loudness with the midi mask
-        ld_scaled = perf_ld_scaled.numpy()
-        ld_orig = ld_scaled.copy()
-        ld_scaled *= midi_mask
-        ld_scaled = tf.convert_to_tensor(ld_scaled)
+    '''
+    # resampling
+    if resample_ratio < 1.0:
 
-    else:
-        ld_scaled = perf_ld_scaled
+        ld_scaled = ddsp.core.resample(
+            ld_scaled, int(ld_scaled.shape[1]*resample_ratio))
+        f0_scaled = ddsp.core.resample(
+            f0_scaled, int(f0_scaled.shape[1]*resample_ratio))
+        f0_hz = ddsp.core.resample(
+            f0_hz, int(f0_hz.shape[1]*resample_ratio))
+    '''
 
     ##### synthesis #####
 
-    synth_inputs = {
-        "ld_scaled": ld_scaled,
-        "f0_scaled": f0_scaled,
-        "f0_hz":  f0_hz
-    }
+    midi_batch = {k: tf.convert_to_tensor(batch[k], tf.float32) for k in ["midi_pitch", "midi_velocity"]}
+    synth_inputs = control_inputs(performance_params, midi_batch,
+                                  naive_perc, loudness_perc, float(vibrato_on), vibrato_level, vibrato_hz)
 
     if do_plots:
         print('Plotting')
+        # the first tune of a batch
+        plot_name = midi_name if isinstance(midi_name, str) else midi_name[0]
         limit = 2000
-        plot_synth_inputs(ld_orig[0][:limit], ld_scaled.numpy()[0][:limit], f0_orig[0][:limit], f0_scaled.numpy()[0][:limit], midi_name, plot_export_path)
+        ld_orig = performance_params["predicted_ld_scaled"].numpy()
+        f0_orig = performance_params["predicted_f0_scaled"].numpy()
+        plot_synth_inputs(ld_orig[0][:limit], synth_inputs["ld_scaled"].numpy()[0][:limit], f0_orig[0][:limit], synth_inputs["f0_scaled"].numpy()[0][:limit], plot_name, plot_export_path)
         print('Done')
 
-    # generate audio
-    performance_audio = synthesis_model.decode(synth_inputs)
-    return performance_audio[..., None]
+    return synth_inputs
 
 def plot_synth_inputs(ld_orig, ld_sc, f0_orig, f0_sc, midi_name, path):
 
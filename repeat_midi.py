@@ -1,13 +1,8 @@
-import music21 as m21
 import pretty_midi
+import metrics
 
-def main(file, n, output):
-    # use music21 to expand repeats
-    tune = m21.converter.parse(file).parts[0].expandRepeats()
-    tune.write('midi', output)
-
-    # use pretty midi to repeat
-    tune = pretty_midi.PrettyMIDI(file)
+def repeat(tune, n):
+    """A new pretty_midi tune playing `tune` n times."""
     new_tune = pretty_midi.PrettyMIDI()
 
     for k in tune.key_signature_changes:
@@ -27,7 +22,13 @@ def main(file, n, output):
             shift = new_instr.notes[-1].end
         new_tune.instruments.append(new_instr)
 
-    new_tune.write(output)
+    return new_tune
+
+
+@metrics.measured('repeat_midi', tune_arg=0)
+def main(file, n, output):
+    # use pretty midi to repeat
+    repeat(pretty_midi.PrettyMIDI(file), n).write(output)
 
 if __name__ == 'main':
     import argparse
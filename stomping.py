@@ -3,21 +3,24 @@ import random
 import os
 import numpy as np
 import soundfile as sf
-import music21 as m21
+import tune_cache
+import assets
+import metrics
 
-def main(file, tempo, output):
-    if not os.path.exists(output):
-        os.makedirs(output)
+def stomp_name(file, tempo):
+    return f'{os.path.basename(file)}_stomps_0_{tempo}.wav'
 
-    # get tune and bars
-    tune = m21.converter.parse(file)
-    bars = tune.parts[0].getElementsByClass(m21.stream.Measure)
 
-    # get tempo and calculate bar duration in quarters
+@metrics.measured('stomping', tune_arg=2)
+def write_stomps(meta, tempo, path):
+    """Write the stomps of a tune, from its metadata (see tune_cache.metadata)."""
+
+    # get bars, as (offset, duration), and bar duration in quarters
+    bars = meta['bars']
+    bar_duration = meta['bar_duration']
+
+    # get tempo
     tempo = int(tempo)
-    time_signature = tune.recurse().getElementsByClass(m21.meter.TimeSignature)[0]
-    beat_duration = time_signature.beatDuration.quarterLength
-    bar_duration = time_signature.beatCount * beat_duration
 
     # calculate duration of one quarter with the given tempo
     quarter_seconds = 60/tempo
@@ -29,17 +32,17 @@ def main(file, tempo, output):
     SAMPLE_RATE = 16000
     stomping = np.zeros(int(SAMPLE_RATE*duration))
 
-    # load stomping samples
+    # load stomping samples (once per process)
     stomp_dir = './stomps'
-    stomps = [sf.read(f'{stomp_dir}/{s}')[0] for s in os.listdir(stomp_dir)]
+    stomps = assets.load_dir(stomp_dir)
 
-    for bar in bars:
-        index = int(bar.offset*quarter_seconds*SAMPLE_RATE)
+    for bar_offset, bar_length in bars:
+        index = int(bar_offset*quarter_seconds*SAMPLE_RATE)
         sample = random.choice(stomps)*random.uniform(0.8,1)
         end_index = min(len(stomping), index + len(sample))
         stomping[index : end_index] += sample[ : end_index-index]
 
-        index = int((bar.offset+bar.duration.quarterLength/2)*quarter_seconds*SAMPLE_RATE)
+        index = int((bar_offset+bar_length/2)*quarter_seconds*SAMPLE_RATE)
         sample = random.choice(stomps)*random.uniform(0.8,1)
         end_index = min(len(stomping), index + len(sample))
         stomping[index : end_index] += sample[ : end_index-index]
@@ -47,9 +50,17 @@ def main(file, tempo, output):
 
 
 
-    with sf.SoundFile(f'{output}/{os.path.basename(file)}_stomps_0_{tempo}.wav', 'w', samplerate=SAMPLE_RATE, channels=len(stomping.shape)) as f:
+    with sf.SoundFile(path, 'w', samplerate=SAMPLE_RATE, channels=len(stomping.shape)) as f:
         f.write(stomping)
 
+
+def main(file, tempo, output):
+    if not os.path.exists(output):
+        os.makedirs(output)
+
+    # analyzed once per tune, without parsing it again
+    write_stomps(tune_cache.metadata(file), tempo, f'{output}/{stomp_name(file, tempo)}')
+
 if __name__ == '__main__':
     # args
     parser = argparse.ArgumentParser(description='Generate stomping to accompany a tune')
@@ -0,0 +1,54 @@
+import random
+
+import pretty_midi
+import pytest
+
+import abc_spicer
+import tune_cache
+from test_fastparse import synthetic
+
+TEMPO = 120
+
+
+def write_tune(path, notes, meter):
+    """A tune of (pitch, start, end) notes, in quarters."""
+    midi = pretty_midi.PrettyMIDI(initial_tempo=TEMPO)
+    midi.time_signature_changes.append(pretty_midi.TimeSignature(*meter, 0))
+    midi.key_signature_changes.append(pretty_midi.KeySignature(2, 0))
+    instr = pretty_midi.Instrument(program=0)
+    for pitch, start, end in notes:
+        instr.notes.append(pretty_midi.Note(velocity=80, pitch=pitch, start=start*60/TEMPO, end=end*60/TEMPO))
+    midi.instruments.append(instr)
+    midi.write(path)
+    return path
+
+
+def spiced(path, instr, spice, seed, output):
+    random.seed(seed)
+    tune_cache.clear()
+    out = abc_spicer.main(path, instr, spice, TEMPO, output)
+    return [(n.pitch, round(n.start*TEMPO/60, 3), round(n.end*TEMPO/60, 3))
+            for n in pretty_midi.PrettyMIDI(out).instruments[0].notes]
+
+
+def test_tied_notes_as_music21(tmp_path):
+    # in 2/4: notes tied over one and two bar lines, and tied in the middle of the tune
+    path = write_tune(str(tmp_path / 'ties.mid'), [
+        (62, 0, 2), (64, 2, 3), (67, 3, 3.75), (67, 3.75, 4.5), (69, 4.5, 5), (64, 5, 6), (62, 6, 6.25),
+        (71, 6.25, 8.25), (69, 8.25, 9), (62, 9, 10), (66, 10, 11.5), (67, 11.5, 12.25), (69, 12.25, 14),
+        (74, 14, 16), (62, 16, 18)], (2, 4))
+
+    # no ornaments at spice 0, the notes before the last bar are the tied notes as music21 merges them
+    notes = spiced(path, 'fiddle', 0.0, 0, str(tmp_path))
+    merged = [(n.pitch.midi, round(float(n.offset), 3), round(float(n.offset + n.duration.quarterLength), 3))
+              for n in tune_cache.parse(path).flatten().stripTies().notes]
+    assert notes[:-1] == [n for n in merged if n[2] <= 16]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_short_notes(tmp_path, seed):
+    # triplets and ties leave parts of notes shorter than a cut
+    for file in synthetic(tmp_path, 20, seed=seed):
+        for instr in ['fiddle', 'whistle']:
+            notes = spiced(file, instr, 1.0, seed, str(tmp_path))
+            assert all(end > start for _, start, end in notes)
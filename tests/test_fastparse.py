@@ -0,0 +1,82 @@
+import random
+from fractions import Fraction
+
+import pretty_midi
+import pytest
+
+import benchmark
+import fastparse
+import repeat_midi
+import tune_cache
+
+# note groups in quarters: quavers, triplets, notes tied over the bar line, sixteenths
+RHYTHMS = {
+    'jig': [(Fraction(1, 2),)],
+    'triplets': [(Fraction(1, 2),), (Fraction(1),), (Fraction(1, 3),)*3],
+    'ties': [(Fraction(1, 2),), (Fraction(3, 2),), (Fraction(5, 2),), (Fraction(3, 4), Fraction(1, 4))],
+    'reel': [(Fraction(1, 4),)*2, (Fraction(1, 2),), (Fraction(1),)],
+}
+METERS = [(6, 8), (9, 8), (12, 8), (3, 8), (2, 4), (3, 4), (4, 4), (5, 4), (2, 2)]
+PICKUPS = [0, 0, Fraction(1, 2), Fraction(1), Fraction(1, 3)]
+
+SYNTHETIC_TUNES = 100
+
+
+def synthetic(folder, n, seed=0):
+    """`n` synthetic tunes with pickups, several meters, keys or none, and some of them repeated."""
+    rng = random.Random(seed)
+    files = []
+    for i in range(n):
+        path = f'{folder}/synthetic{i}.mid'
+        key = rng.randrange(24)
+        benchmark.make_tune(path, rng.randint(1, 16), rng, meter=rng.choice(METERS),
+                            key=key if rng.random() < 0.8 else None, rhythm=RHYTHMS[rng.choice(sorted(RHYTHMS))],
+                            pickup=rng.choice(PICKUPS))
+        files.append(path)
+
+        # as the spicer reads them
+        if rng.random() < 0.3:
+            repeat_midi.repeat(pretty_midi.PrettyMIDI(path), 3).write(f'{folder}/synthetic{i}_repeated.mid')
+            files.append(f'{folder}/synthetic{i}_repeated.mid')
+
+    return files
+
+
+@pytest.fixture(scope='module')
+def tunes(tmp_path_factory):
+    return synthetic(tmp_path_factory.mktemp('synthetic'), SYNTHETIC_TUNES)
+
+
+def test_synthetic_tunes_are_supported(tunes):
+    for file in tunes:
+        fastparse.read(file)
+
+
+def test_synthetic_tunes_have_ties(tunes):
+    ties = {n[3] for file in tunes for _, _, notes in fastparse.read(file)['bars'] for n in notes}
+    assert {'start', 'continue', 'stop'} <= ties
+
+
+def test_parity_with_music21(tunes):
+    # bars, notes and ties as music21 reads them
+    assert fastparse.check(tunes) == []
+
+
+def test_tie_over_two_bar_lines(tmp_path):
+    midi = pretty_midi.PrettyMIDI(initial_tempo=120)
+    midi.time_signature_changes.append(pretty_midi.TimeSignature(2, 4, 0))
+    instr = pretty_midi.Instrument(program=0)
+    # a quaver, then a note of 4.5 quarters from the middle of the first bar
+    instr.notes.append(pretty_midi.Note(velocity=80, pitch=62, start=0, end=0.25))
+    instr.notes.append(pretty_midi.Note(velocity=80, pitch=67, start=0.25, end=2.5))
+    midi.instruments.append(instr)
+    path = str(tmp_path / 'tie.mid')
+    midi.write(path)
+
+    bars = fastparse.read(path)['bars']
+    assert [notes for _, _, notes in bars] == [
+        [(62, 0.0, 0.5, None), (67, 0.5, 1.5, 'start')],
+        [(67, 0.0, 2.0, 'continue')],
+        [(67, 0.0, 1.0, 'stop')],
+    ]
+    assert bars == tune_cache.from_music21(tune_cache.parse(path))['bars']
@@ -0,0 +1,162 @@
+import io
+import os
+import copy
+import json
+import hashlib
+from fractions import Fraction
+from collections import OrderedDict
+import fastparse
+
+# parsed scores and bars kept per process, keyed by path and modification time
+# (tunes given as midi data, see encode, by their content)
+MAX_TUNES = 16
+_tunes = OrderedDict()
+_bars = OrderedDict()
+
+# analyzed metadata (key, time signature, bars), kept on disk and keyed by the content of the tune
+# (the last MAX_TUNES also in memory)
+TUNE_CACHE_DIR = os.environ.get('FOLKRNN_TUNE_CACHE', './.tune_cache')
+_metadata = OrderedDict()
+# version of the cached metadata, entries of older versions are analyzed again
+META_VERSION = 2
+
+
+def encode(midi):
+    """The midi data of an in-memory tune (pretty_midi), the tune as the next stage would read it from a file."""
+    data = io.BytesIO()
+    midi.write(data)
+    return data.getvalue()
+
+
+def digest(file):
+    if isinstance(file, bytes):
+        return hashlib.sha1(file).hexdigest()
+    with open(file, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def parse(file, copy_tune=False):
+    """
+    Parse `file` (a path or midi data) with music21, reusing the score if the file did not change since the last parse.
+
+    Stages that modify the notes must ask for a copy (`copy_tune=True`),
+    the cached score is shared by every caller.
+    """
+    # music21 is slow to import, only the tunes the fast reader cannot handle need it
+    import music21 as m21
+    tune = cached(_tunes, file, lambda f: m21.converter.parse(f, format='midi' if isinstance(f, bytes) else None))
+    return copy.deepcopy(tune) if copy_tune else tune
+
+
+def cached(cache, file, load):
+    key = digest(file) if isinstance(file, bytes) else (os.path.abspath(file), os.stat(file).st_mtime_ns)
+
+    if key in cache:
+        cache.move_to_end(key)
+    else:
+        cache[key] = load(file)
+        if len(cache) > MAX_TUNES:
+            cache.popitem(last=False)
+
+    return cache[key]
+
+
+def from_music21(tune):
+    """Tonic, bar duration and bars of a parsed tune, in the form of fastparse.read."""
+    import music21 as m21
+    time_signature = tune.recurse().getElementsByClass(m21.meter.TimeSignature)[0]
+
+    key = tune.recurse().getElementsByClass(m21.key.KeySignature)
+    if len(key) == 0:
+        key = tune.analyze('key')
+    else:
+        key = key[0]
+
+    bars = tune.parts[0].getElementsByClass(m21.stream.Measure)
+
+    return {
+        'tonic': key.tonic.pitchClass,
+        'bar_duration': time_signature.barDuration.quarterLength,
+        'bars': [(bar.offset, bar.duration.quarterLength,
+                  [(n.pitch.midi, n.offset, n.duration.quarterLength, n.tie.type if n.tie is not None else None)
+                   for n in bar.notes]) for bar in bars],
+    }
+
+
+def read_bars(file):
+    try:
+        return fastparse.read(io.BytesIO(file) if isinstance(file, bytes) else file)
+    except fastparse.Unsupported:
+        return from_music21(parse(file))
+
+
+def read(file):
+    """
+    Bars of a tune (a path or midi data), read without music21 when the fast reader supports it (see fastparse.read).
+    The tonic is None for tunes without key signature, `metadata` has it.
+    """
+    return cached(_bars, file, read_bars)
+
+
+def quarter_length(q):
+    # quarter lengths are floats or, when not exact in binary, fractions; stored as strings
+    return fastparse.op_frac(Fraction(q))
+
+
+def analyze(file):
+    """Key tonic pitch class, bar duration and (offset, duration) of every bar of a tune."""
+    tune = read(file)
+    tonic = tune['tonic']
+    if tonic is None:
+        # key analysis is only in music21
+        tonic = from_music21(parse(file))['tonic']
+
+    return {
+        'tonic': tonic,
+        'bar_duration': str(tune['bar_duration']),
+        'bars': [[str(o), str(d)] for o, d, _ in tune['bars']],
+    }
+
+
+def metadata(file):
+    """
+    Key, time signature and bar structure of a tune (a path or midi data), analyzed once for all parts and runs.
+
+    Returns a dict with `tonic` (pitch class), `bar_duration` and `bars`,
+    a list of (offset, duration), all durations in quarter lengths.
+    """
+    key = digest(file)
+
+    if key in _metadata:
+        _metadata.move_to_end(key)
+    else:
+        path = f'{TUNE_CACHE_DIR}/{key}.{META_VERSION}.json'
+        if os.path.exists(path):
+            with open(path) as f:
+                meta = json.load(f)
+        else:
+            meta = analyze(file)
+
+            # several processes may analyze the same tune
+            os.makedirs(TUNE_CACHE_DIR, exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(meta, f)
+            os.replace(tmp, path)
+
+        _metadata[key] = meta
+        if len(_metadata) > MAX_TUNES:
+            _metadata.popitem(last=False)
+
+    meta = _metadata[key]
+    return {
+        'tonic': meta['tonic'],
+        'bar_duration': quarter_length(meta['bar_duration']),
+        'bars': [(quarter_length(o), quarter_length(d)) for o, d in meta['bars']],
+    }
+
+
+def clear():
+    _tunes.clear()
+    _bars.clear()
+    _metadata.clear()